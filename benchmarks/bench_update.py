@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark the model update path with synthetic lattices.
+
+Each update runs the same stages as the app does for one tick: settings sync
+and model run (OnlineModelEngine.simulate), data collection, Twiss
+extraction, diag reads and redraw of the envelope/ellipse figures (Agg).
+
+Scenarios:
+
+- cold: full sync and rebuild of the model for every update;
+- steady: monitor mode, one random quadrupole is changed before every update;
+- idle: monitor mode, nothing is changed;
+- linear: preview of one random quadrupole change (within the tolerance) by
+  the linear surrogate, as the 'Linear Preview' of the app, full run if the
+  preview is not possible.
+
+The results (throughput and per-stage latency percentiles) are written into
+``benchmarks/results/<commit>.json``, compare two of them with
+``compare.py``.
+
+>>> python benchmarks/bench_update.py --sizes 100 1000 10000 -n 20
+"""
+import argparse
+import datetime
+import json
+import pathlib
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from fakes import make_machine
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+SCENARIOS = ('cold', 'steady', 'idle', 'linear')
+
+
+def import_app():
+    # the installed package, or the one in the source tree.
+    try:
+        from aris_apps.myapp import engine, plotting
+    except ImportError:
+        sys.path.insert(0, str(HERE.parent.joinpath("src")))
+        from myApp import engine, plotting
+    return engine, plotting
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Figures(object):
+    """Envelope and ellipse figures drawn with Agg, as a stand-in of the app.
+    """
+    def __init__(self, plotting):
+        self.fig = Figure(figsize=(12, 8), dpi=72)
+        FigureCanvasAgg(self.fig)
+        ax1, ax2, ax3 = (self.fig.add_subplot(2, 1, 1), self.fig.add_subplot(2, 2, 3),
+                         self.fig.add_subplot(2, 2, 4))
+        self.lines = [ax1.plot([], [])[0] for _ in range(4)]
+        self.ax = ax1
+        self.ellipses = {'x': plotting.EllipseArtist(ax2), 'y': plotting.EllipseArtist(ax3)}
+
+    def draw(self, pos, xrms, yrms, diag, params):
+        self.lines[0].set_data(pos, xrms)
+        self.lines[1].set_data(pos, yrms)
+        if diag is not None:
+            self.lines[2].set_data(diag[0], diag[1])
+            self.lines[3].set_data(diag[0], diag[2])
+        self.ax.relim()
+        self.ax.autoscale_view()
+        for xoy in 'xy':
+            self.ellipses[xoy].update(params, xoy)
+        self.fig.canvas.draw()
+
+
+def update(engine, figures, target):
+    # one tick of the app.
+    results, r, fm = engine.simulate(target)
+    pos, xcen, ycen, xrms, yrms = engine.collect_data(results, fm)
+    params_x, params_y = engine.twiss_params(r[0][-1])
+    params_x.update(params_y)
+    diag = engine.diag_data('envelope')
+    with engine.timer.stage('plot_redraw'):
+        figures.draw(pos, xrms, yrms, diag, params_x)
+
+
+def preview(engine, figures, target, ename, value):
+    # one linear preview of the app.
+    r = engine.linear_update({(ename, 'B2'): value}, target)
+    if r is None:
+        update(engine, figures, target)
+        return
+    (pos, xcen, ycen, xrms, yrms), (params_x, params_y) = r
+    params_x.update(params_y)
+    diag = engine.diag_data('envelope')
+    with engine.timer.stage('plot_redraw'):
+        figures.draw(pos, xrms, yrms, diag, params_x)
+
+
+def run_scenario(engine_mod, plotting, scenario, size, n, ca_delay, seed=0):
+    mp = make_machine(size, ca_delay, seed)
+    engine = engine_mod.OnlineModelEngine()
+    engine.set_lattice(mp)
+    lat = engine.lat
+    target = [e.name for e in lat][-1]
+    engine.select_diags('envelope', [e.name for e in lat if e.family == 'PM'])
+    figures = Figures(plotting)
+    quads = [e for e in lat if e.family == 'QUAD']
+    rng = np.random.default_rng(seed)
+
+    if scenario != 'cold':
+        engine.start_monitor()
+    update(engine, figures, target) # warm up
+    engine.timer.reset()
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        if scenario == 'cold':
+            engine.session.reset()
+        elif scenario == 'steady':
+            fld = quads[rng.integers(len(quads))].get_field('B2')
+            fld.value = fld.current_setting() * rng.uniform(0.95, 1.05)
+        with engine.timer.stage('update'):
+            if scenario == 'linear':
+                q = quads[rng.integers(len(quads))]
+                v0 = engine.session.settings[(q.name, 'B2')]
+                preview(engine, figures, target, q.name, v0 * rng.uniform(0.97, 1.03))
+            else:
+                update(engine, figures, target)
+    dt = time.perf_counter() - t0
+
+    if scenario != 'cold':
+        engine.stop_monitor()
+    engine.diag.clear()
+    return {'n': n, 'throughput': n / dt, 'stages': engine.timer.stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Benchmark the model update path with synthetic lattices.")
+    parser.add_argument("--sizes", nargs='+', type=int, default=[100, 1000, 10000],
+            help="Numbers of elements of the synthetic lattices.")
+    parser.add_argument("--scenarios", nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+            help="Scenarios to run, default is all.")
+    parser.add_argument("-n", dest="n", type=int, default=20,
+            help="Number of updates of each run.")
+    parser.add_argument("--ca-delay", dest="ca_delay", type=float, default=0.0,
+            help="Seconds of each CA get, to emulate the network round trip.")
+    parser.add_argument("-o", "--output", dest="output",
+            help="Output file, default is results/<commit>.json.")
+    args = parser.parse_args(sys.argv[1:])
+
+    engine_mod, plotting = import_app()
+    commit = git_commit()
+    data = {'commit': commit,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'ca_delay': args.ca_delay,
+            'results': {}}
+
+    print(f"{'scenario':<10s}{'size':>8s}{'updates/s':>12s}"
+          f"{'p50 (ms)':>12s}{'p90 (ms)':>12s}  slowest stage (p50, ms)")
+    for scenario in args.scenarios:
+        r = data['results'][scenario] = {}
+        for size in args.sizes:
+            res = r[str(size)] = run_scenario(engine_mod, plotting, scenario, size,
+                                              args.n, args.ca_delay)
+            st = res['stages']
+            total = st['update']
+            slowest = max((k for k in st if k not in ('update', 'simulate')),
+                          key=lambda k: st[k]['p50'])
+            print(f"{scenario:<10s}{size:>8d}{res['throughput']:>12.1f}"
+                  f"{total['p50'] * 1e3:>12.2f}{total['p90'] * 1e3:>12.2f}"
+                  f"  {slowest} ({st[slowest]['p50'] * 1e3:.2f})")
+
+    if args.output is None:
+        outpath = HERE.joinpath("results", f"{commit}.json")
+    else:
+        outpath = pathlib.Path(args.output)
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(outpath, 'w') as fp:
+        json.dump(data, fp, indent=2, default=float)
+    print(f"Saved to {outpath}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compare two benchmark results of ``bench_update.py``.
+
+>>> python benchmarks/compare.py results/abc1234.json results/def5678.json
+"""
+import argparse
+import json
+import sys
+
+
+def read_json(filepath):
+    with open(filepath, 'r') as fp:
+        return json.load(fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Compare the median latency of two benchmark results.")
+    parser.add_argument("base", help="Benchmark results as the base.")
+    parser.add_argument("new", help="Benchmark results to compare.")
+    parser.add_argument("--stage", default="update",
+            help="Stage to compare, default is the whole update.")
+    args = parser.parse_args(sys.argv[1:])
+
+    base, new = read_json(args.base), read_json(args.new)
+    print(f"{base['commit']} -> {new['commit']}, {args.stage} p50 (ms)")
+    print(f"{'scenario':<10s}{'size':>8s}{'base':>12s}{'new':>12s}{'ratio':>8s}")
+    for scenario, r in new['results'].items():
+        for size, res in r.items():
+            try:
+                t0 = base['results'][scenario][size]['stages'][args.stage]['p50']
+                t1 = res['stages'][args.stage]['p50']
+            except KeyError:
+                continue
+            print(f"{scenario:<10s}{size:>8s}{t0 * 1e3:>12.2f}{t1 * 1e3:>12.2f}"
+                  f"{t1 / t0:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
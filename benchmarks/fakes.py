@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""In-process stand-ins of MachinePortal, CA and FLAME for the benchmarks.
+
+Only the interfaces used by the online model are implemented, the physics is
+a thin-lens linear optics model, good enough to give the same amount of work
+per element as the real model does on the Python side.
+
+>>> mp = make_machine(1000)
+>>> engine = OnlineModelEngine()
+>>> engine.set_lattice(mp)
+"""
+import math
+import time
+
+import numpy as np
+
+# pattern of the synthetic lattice, repeated up to the required length
+CELL = ('DRIFT', 'QUAD', 'DRIFT', 'HCOR', 'VCOR', 'DRIFT', 'QUAD', 'DRIFT', 'PM', 'BPM')
+
+# physics fields with settings of each family
+SETTING_FIELDS = {'QUAD': ('B2',), 'HCOR': ('ANG',), 'VCOR': ('ANG',)}
+
+# readback fields of each diag family
+DIAG_FIELDS = {'PM': ('XRMS', 'YRMS', 'XCEN', 'YCEN'), 'BPM': ('XCEN', 'YCEN')}
+
+# FLAME element property of each (family, field)
+FLAME_PROPS = {('QUAD', 'B2'): 'B2', ('HCOR', 'ANG'): 'theta_x', ('VCOR', 'ANG'): 'theta_y'}
+
+
+class FakePV(object):
+    """PV with monitor callbacks, a put runs the callbacks in place.
+    """
+    def __init__(self, pvname, value=0.0, delay=0.0):
+        self.pvname = pvname
+        self._value = value
+        self._delay = delay
+        self._callbacks = {}
+        self._next_index = 0
+
+    def get(self):
+        if self._delay:
+            time.sleep(self._delay)
+        return self._value
+
+    def put(self, value):
+        self._value = value
+        for cb in list(self._callbacks.values()):
+            cb(pvname=self.pvname, value=value)
+
+    def add_callback(self, callback, run_now=False):
+        self._next_index += 1
+        self._callbacks[self._next_index] = callback
+        if run_now:
+            callback(pvname=self.pvname, value=self._value)
+        return self._next_index
+
+    def remove_callback(self, index):
+        self._callbacks.pop(index, None)
+
+
+class FakeField(object):
+    """Dynamic field of an element, with one setpoint and one readback PV.
+    """
+    def __init__(self, ename, name, value=0.0, delay=0.0):
+        self.name = name
+        self.setpoint_pv = [FakePV(f"{ename}:{name}_CSET", value, delay)]
+        self.readback_pv = [FakePV(f"{ename}:{name}_RD", value, delay)]
+
+    @property
+    def value(self):
+        return self.readback_pv[0].get()
+
+    @value.setter
+    def value(self, x):
+        self.setpoint_pv[0].put(x)
+        self.readback_pv[0].put(x)
+
+    def current_setting(self):
+        return self.setpoint_pv[0].get()
+
+
+class FakeElement(object):
+    def __init__(self, name, family, sb, length, fields):
+        self.name = name
+        self.family = family
+        self.sb = sb
+        self.length = length
+        self._fields = {f.name: f for f in fields}
+
+    @property
+    def fields(self):
+        return list(self._fields)
+
+    def get_field(self, name):
+        return self._fields.get(name)
+
+    def __getattr__(self, name):
+        # read dynamic fields as attributes, like CaElement.
+        fields = self.__dict__.get('_fields', {})
+        if name in fields:
+            return fields[name].value
+        raise AttributeError(name)
+
+
+class FakeLayout(object):
+    def __init__(self, z=0.0):
+        self.z = z
+
+
+class FakeLattice(object):
+    """Lattice of *elements* (list of FakeElement).
+    """
+    def __init__(self, elements):
+        self._elements = elements
+        self._map = {e.name: e for e in elements}
+        self.layout = FakeLayout()
+        self.settings = {
+            e.name: {f: e.get_field(f).current_setting() for f in SETTING_FIELDS[e.family]}
+            for e in elements if e.family in SETTING_FIELDS}
+
+    def __iter__(self):
+        return iter(self._elements)
+
+    def __len__(self):
+        return len(self._elements)
+
+    def __getitem__(self, name):
+        return self._map.get(name)
+
+    def sync_settings(self):
+        for ename, flds in self.settings.items():
+            elem = self._map[ename]
+            for fname in flds:
+                flds[fname] = elem.get_field(fname).current_setting()
+
+    def run(self, src_conf=None):
+        confs = [{'name': 'S', 'type': 'source', 'L': 0.0}]
+        for e in self._elements:
+            c = {'name': e.name, 'type': e.family, 'L': e.length}
+            for fname, v in self.settings.get(e.name, {}).items():
+                c[FLAME_PROPS[(e.family, fname)]] = v
+            confs.append(c)
+        return None, FakeModelFlame(FakeMachine(confs), src_conf)
+
+
+class FakeMachinePortal(object):
+    def __init__(self, lat, machine="FAKE", segment="SYN"):
+        self.work_lattice_conf = lat
+        self.last_machine_name = machine
+        self.last_lattice_name = segment
+
+
+class FakeBeamState(object):
+    """Beam state kept as moment arrays, the attributes are derived from them
+    on access, like flame_utils.BeamState does.
+    """
+    def __init__(self, pos=0.0, m0=None, twiss=None):
+        self.pos = pos
+        # x [mm], x' [rad], y, y', phi, dEk, 1
+        self._m0 = np.array([0, 0, 0, 0, 0, 0, 1.0]) if m0 is None else m0.copy()
+        # alpha_x, beta_x [m], emit_x [mm-mrad], alpha_y, beta_y, emit_y
+        self._twiss = np.array([-1.0, 4.0, 1.0, 1.0, 4.0, 1.0]) if twiss is None \
+                      else twiss.copy()
+        # transfer matrix of the last element, in (mm, rad)
+        self.transfer_matrix = np.eye(7)
+
+    def clone(self):
+        s = FakeBeamState(self.pos, self._m0, self._twiss)
+        s.transfer_matrix = self.transfer_matrix.copy()
+        return s
+
+    @property
+    def moment0_env(self):
+        return self._m0.copy()
+
+    @property
+    def moment0_rms(self):
+        ax, bx, ex, ay, by, ey = self._twiss
+        return np.array([math.sqrt(ex * bx), math.sqrt(ex * (1 + ax * ax) / bx) * 1e-3,
+                         math.sqrt(ey * by), math.sqrt(ey * (1 + ay * ay) / by) * 1e-3,
+                         0.0, 0.0, 0.0])
+
+    @property
+    def moment1_env(self):
+        s = np.zeros((7, 7))
+        for i, (alpha, beta, emit) in enumerate((self._twiss[:3], self._twiss[3:])):
+            g = (1 + alpha * alpha) / beta
+            s[2 * i:2 * i + 2, 2 * i:2 * i + 2] = emit * np.array(
+                    [[beta, -alpha * 1e-3], [-alpha * 1e-3, g * 1e-6]])
+        return s
+
+    xcen = property(lambda self: self.moment0_env[0])
+    xpcen = property(lambda self: self.moment0_env[1] * 1e3)
+    ycen = property(lambda self: self.moment0_env[2])
+    ypcen = property(lambda self: self.moment0_env[3] * 1e3)
+    xrms = property(lambda self: self.moment0_rms[0])
+    xprms = property(lambda self: self.moment0_rms[1] * 1e3)
+    yrms = property(lambda self: self.moment0_rms[2])
+    yprms = property(lambda self: self.moment0_rms[3] * 1e3)
+    xtwiss_alpha = property(lambda self: self._twiss[0])
+    xtwiss_beta = property(lambda self: self._twiss[1])
+    xemittance = property(lambda self: self._twiss[2])
+    ytwiss_alpha = property(lambda self: self._twiss[3])
+    ytwiss_beta = property(lambda self: self._twiss[4])
+    yemittance = property(lambda self: self._twiss[5])
+    xnemittance = property(lambda self: self._twiss[2] * 0.1)
+    ynemittance = property(lambda self: self._twiss[5] * 0.1)
+
+    def propagate(self, conf):
+        m0, tw = self._m0, self._twiss
+        t = conf['type']
+        L = conf.get('L', 0.0)
+        M = np.eye(7)
+        M[0, 1] = M[2, 3] = L * 1e3
+        if L:
+            for i, (a, b) in enumerate(((0, 1), (3, 4))):
+                alpha, beta = tw[a], tw[b]
+                g = (1 + alpha * alpha) / beta
+                tw[b] = beta - 2 * alpha * L + g * L * L
+                tw[a] = alpha - g * L
+                m0[2 * i] += m0[2 * i + 1] * L * 1e3
+            self.pos += L
+        if t == 'QUAD':
+            k = conf.get('B2', 0.0) * 0.01
+            for i, (a, b), sgn in ((0, (0, 1), 1), (1, (3, 4), -1)):
+                tw[a] += sgn * k * tw[b]
+                m0[2 * i + 1] -= sgn * k * m0[2 * i] * 1e-3
+            K = np.eye(7)
+            K[1, 0], K[3, 2] = -k * 1e-3, k * 1e-3
+            M = K @ M
+        elif t == 'HCOR':
+            m0[1] += conf.get('theta_x', 0.0)
+            M[1, 6] = conf.get('theta_x', 0.0)
+        elif t == 'VCOR':
+            m0[3] += conf.get('theta_y', 0.0)
+            M[3, 6] = conf.get('theta_y', 0.0)
+        self.transfer_matrix = M
+
+
+class FakeMachine(object):
+    def __init__(self, confs):
+        self._confs = confs
+        self._index = {}
+        for i, c in enumerate(confs):
+            self._index.setdefault(c['name'], []).append(i)
+
+    def __len__(self):
+        return len(self._confs)
+
+    def conf(self, i):
+        return self._confs[i]
+
+    def find(self, name=None):
+        return list(self._index.get(name, []))
+
+    def reconfigure(self, i, conf):
+        self._confs[i].update(conf)
+
+
+class FakeModelFlame(object):
+    def __init__(self, machine, src_conf=None):
+        self.machine = machine
+        self._bs = FakeBeamState()
+
+    def run(self, bmstate=None, from_element=None, to_element=None, monitor=None):
+        s = self._bs.clone() if bmstate is None else bmstate
+        i0 = 0 if from_element is None else from_element
+        i1 = len(self.machine) - 1 if to_element is None else to_element
+        if monitor == 'all':
+            monitor = range(i0, i1 + 1)
+        monitor = set() if monitor is None else set(monitor)
+        results = []
+        for i in range(i0, i1 + 1):
+            s.propagate(self.machine.conf(i))
+            if i in monitor:
+                results.append((i, s.clone()))
+        return results, s
+
+    def collect_data(self, results, *keys):
+        return {k: np.array([getattr(s, k) for _, s in results]) for k in keys}
+
+
+def make_machine(n, ca_delay=0.0, seed=0):
+    """Return a FakeMachinePortal of a synthetic lattice of *n* elements, each
+    CA get takes *ca_delay* seconds.
+    """
+    rng = np.random.default_rng(seed)
+    elems, sb = [], 0.0
+    for i in range(n):
+        family = CELL[i % len(CELL)]
+        length = 0.2 if family in ('DRIFT', 'QUAD') else 0.0
+        name = f"SYN:{family}_D{i:05d}"
+        fields = []
+        for fname in SETTING_FIELDS.get(family, ()):
+            # FODO with small errors, correctors with small kicks.
+            v = 8 * rng.uniform(0.99, 1.01) * (-1)**(i // 5) if family == 'QUAD' \
+                else rng.uniform(-1e-6, 1e-6)
+            fields.append(FakeField(name, fname, v, ca_delay))
+        for fname in DIAG_FIELDS.get(family, ()):
+            fields.append(FakeField(name, fname, rng.uniform(0, 1e-3), ca_delay))
+        elems.append(FakeElement(name, family, sb, length, fields))
+        sb += length
+    return FakeMachinePortal(FakeLattice(elems))
@@ -17,6 +17,9 @@ def set_entry_points():
     r['gui_scripts'] = [
         f'{EXE_NAME}={PKG_NAME}.myapp:run',
     ]
+    r['console_scripts'] = [
+        f'{EXE_NAME}_batch={PKG_NAME}.myapp.cli:main',
+    ]
     return r
 
 def readme():
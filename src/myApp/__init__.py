@@ -2,10 +2,6 @@
 
 import sys
 
-from phantasy_ui import QApp as QApplication
-
-from .app import MyAppWindow
-
 __version__ = '2.0.0'
 __title__ = 'A New Online Modeling App'
 __authors__ = "Tong Zhang"
@@ -14,11 +10,30 @@ __copyright__ = "(c) 2021, Facility for Rare Isotope beams," \
 __contact__ = "Tong Zhang <zhangt@frib.msu.edu>"
 
 
+def __getattr__(name):
+    # GUI is only imported when needed, the engine could work without it.
+    if name == 'MyAppWindow':
+        from .app import MyAppWindow
+        return MyAppWindow
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def run(cli=False):
+    from .timing import StartupReport
+    report = StartupReport.from_env()
+    with report.stage("import phantasy_ui"):
+        from phantasy_ui import QApp as QApplication
+    with report.stage("import app"):
+        from .app import MyAppWindow
+
     app = QApplication(sys.argv)
-    w = MyAppWindow(version=__version__)
-    w.setWindowTitle(__title__)
-    w.show()
+    with report.stage("create window"):
+        w = MyAppWindow(version=__version__)
+        w.setWindowTitle(__title__)
+    with report.stage("show window"):
+        w.show()
+        app.processEvents()
+    report.print_report()
     if cli:
         app.exec_()
     else:
@@ -15,7 +15,6 @@ Show the available templates:
 """
 import pathlib
 import sys
-import time
 import numpy as np
 from functools import partial
 from collections import OrderedDict
@@ -23,31 +22,45 @@ from collections import OrderedDict
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtCore import QEventLoop
+from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt
 from PyQt5.QtCore import QVariant
 from PyQt5.QtGui import QColor
 from PyQt5.QtGui import QDoubleValidator
+from PyQt5.QtWidgets import QAction
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QLabel
 from PyQt5.QtWidgets import QMainWindow
+from PyQt5.QtWidgets import QMenu
 from PyQt5.QtWidgets import QMessageBox
 
 from mpl4qt.widgets import MatplotlibBaseWidget
-from flame_utils import BeamState
 
-from phantasy import MachinePortal
 from phantasy_ui import BaseAppForm
 from phantasy_ui import delayed_exec
 from phantasy_ui import get_save_filename
-from phantasy_ui.widgets import BeamStateWidget
-from phantasy_ui.widgets import ElementSelectionWidget
-from phantasy_ui.widgets import ProbeWidget
-from phantasy_ui.widgets import LatticeWidget
-from phantasy_ui.widgets import DataAcquisitionThread as DAQT
-from phantasy_apps.allison_scanner.data import draw_beam_ellipse_with_params
-from phantasy_apps.trajectory_viewer.utils import ElementListModel
 from mpl4qt.widgets.utils import MatplotlibCurveWidgetSettings
 
+from .engine import OnlineModelEngine
+from .engine import TWISS_KEYS_X
+from .engine import TWISS_KEYS_Y
+from .model import snapshot_settings
+from .plotting import BlitUpdater
+from .plotting import EllipseArtist
+from .plotting import LayoutCache
+from .plotting import time_renders
+from .recorder import BEAM_KEYS
+from .recorder import TickRecorder
 from .utils import ResultsModel
-from .utils import TWISS_KEYS_X
-from .utils import TWISS_KEYS_Y
+from .widgets import FitWidget
+from .widgets import ReplayWidget
+from .widgets import ResidualWidget
+from .widgets import ResponseWidget
+from .widgets import ScanWidget
+from .widgets import TimingWidget
+from .worker import DEFAULT_SETTLE_WINDOW
+from .worker import SettingCoalescer
+from .worker import SimulationWorker
 from .ui.ui_app import Ui_MainWindow
 
 DEFAULT_MACHINE, DEFAULT_SEGMENT = "ARIS_VA", "F1"
@@ -63,7 +76,6 @@ p, li {{ white-space: pre-wrap; }}
 <p align="center" style=" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;"><img src="{0}" /></p></body></html>
 """
 
-DIAG_FLD_MAP = {'envelope': ('sb', 'XRMS', 'YRMS'), 'trajectory': ('sb', 'XCEN', 'YCEN')}
 CURPATH = pathlib.Path(__file__)
 MPL_CONF_PATH = CURPATH.parent.joinpath("config")
 ENVELOPE_MPL_CONF_PATH = MPL_CONF_PATH.joinpath("mpl_settings_envelope.json").resolve()
@@ -90,7 +102,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     data_updated2 = pyqtSignal(dict, dict)
 
     # beam state updated, beamstate
-    bs_updated = pyqtSignal(BeamState)
+    bs_updated = pyqtSignal(object)
 
     # selected diag devices changed
     envelope_diags_changed = pyqtSignal(dict)
@@ -103,6 +115,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     diag_data_updated2 = pyqtSignal(tuple)
 
     def __init__(self, version, **kws):
+        # kws: settle_window, millisecond, default is DEFAULT_SETTLE_WINDOW
         super(self.__class__, self).__init__()
 
         # app version, title
@@ -125,9 +138,9 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         self.postInitUi()
 
         # post init
-        self._post_init()
+        self._post_init(**kws)
 
-    def _post_init(self):
+    def _post_init(self, **kws):
         """Initialize UI, user customized code put here.
         """
         self.ENG_DRAWING_MAP = {
@@ -154,8 +167,77 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         # initial vars for FLAME model
         self.fm = None
         self._src_conf = None # initial beam source condition, dict
-        self.updater = None # simulator
-        self._update_delt = 1.0 # second
+        self._target_ename = None # element to show the beam state
+        self._sim_worker = SimulationWorker(self._simulate,
+                                            1.0 / self.update_rate_dsbox.value())
+        self._sim_worker.simStarted.connect(partial(self.set_widgets_status, "START"))
+        self._sim_worker.simFinished.connect(partial(self.set_widgets_status, "STOP"))
+        self._sim_worker.resultsReady.connect(self.on_updater_results_ready)
+        QApplication.instance().aboutToQuit.connect(self._sim_worker.stop)
+        self._sim_worker.start()
+        # online model, GUI-free
+        self._engine = OnlineModelEngine(self._sim_worker.submit)
+        # latest-wins coalescer for new settings from new_cset_dsbox
+        self._cset_coalescer = SettingCoalescer(
+                kws.get('settle_window', DEFAULT_SETTLE_WINDOW), self)
+        self._cset_coalescer.settingsApplied.connect(self.onUpdateModel)
+
+        # monitor-driven update, run model only when settings are changed
+        self.actionMonitor_Update = QAction(self.actionAuto_Update.icon(),
+                                            "Monitor Update", self)
+        self.actionMonitor_Update.setCheckable(True)
+        self.actionMonitor_Update.setToolTip(
+                "Update the model only when the settings are changed on the machine.")
+        self.actionMonitor_Update.toggled.connect(self.onMonitorUpdateModel)
+        self.toolBar.insertAction(self.actionE_xit, self.actionMonitor_Update)
+
+        # tools
+        self.menu_Tools = QMenu("&Tools", self.menubar)
+        self.menubar.insertMenu(self.menu_Help.menuAction(), self.menu_Tools)
+        self.menu_Tools.addAction("Parameter Scan", self.onParameterScan)
+        self._scan_widget = None
+        self.menu_Tools.addAction("Fit Model", self.onFitModel)
+        self._fit_widget = None
+        self.menu_Tools.addAction("Response Matrix", self.onResponseMatrix)
+        self._response_widget = None
+        self.actionLinear_Preview = self.menu_Tools.addAction("Linear Preview")
+        self.actionLinear_Preview.setCheckable(True)
+        self.actionLinear_Preview.setToolTip(
+                "Preview the setting changes with the linearized model, before the full runs.")
+        self._skip_sync = False # run the next update with the model settings
+        self.menu_Tools.addAction("Timing", self.onShowTiming)
+        self._timing_widget = None
+        self.actionRecord = self.menu_Tools.addAction("Record Model")
+        self.actionRecord.setCheckable(True)
+        self.actionRecord.setToolTip("Record the model results of every update to a file.")
+        self.actionRecord.toggled.connect(self.onRecordModel)
+        self._recorder = None # TickRecorder
+        QApplication.instance().aboutToQuit.connect(self.stop_recording)
+        self.menu_Tools.addAction("Replay", self.onReplay)
+        self._replay_widget = None
+        self.menu_Tools.addAction("Residuals", self.onShowResiduals)
+        self._residual_widget = None
+
+        # median durations of the update stages (ms) on the status bar
+        self._timing_label = QLabel()
+        self.statusBar().addPermanentWidget(self._timing_label)
+        # RMS residuals of the diag readings against the model
+        self._residual_label = QLabel()
+        self.statusBar().addPermanentWidget(self._residual_label)
+        self._timing_refresh_timer = QTimer(self)
+        self._timing_refresh_timer.timeout.connect(self.on_refresh_timing)
+        self._timing_refresh_timer.start(1000)
+
+        # Twiss results, rows are updated in place
+        self._results_model = ResultsModel(self.twiss_results_treeView)
+        self._results_model.set_model()
+        v = self.twiss_results_treeView
+        v.setContextMenuPolicy(Qt.ActionsContextMenu)
+        for text, slot in (("Set Current as Reference", self.on_set_twiss_reference),
+                           ("Clear Reference", self.on_clear_twiss_reference)):
+            act = QAction(text, v)
+            act.triggered.connect(slot)
+            v.addAction(act)
 
         # Dict of ProbeWidget for selected element and target element
         self._probe_widgets_dict = {}
@@ -169,16 +251,17 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         self.__mp = None
         self.__lat = None
         self._elem_sel_widgets = {}
-        self._diag_elems = {'envelope': [], 'trajectory': []} # list of CaElement
 
-        # beam state widget
-        self._bs_widget = BeamStateWidget(None, None, None)
-        self.bs_updated.connect(self._bs_widget.bs_updated)
-        self._bs_widget.beam_source_updated[dict].connect(self.on_beam_source_updated)
+        # beam state widget, created when shown
+        self._bs_widget = None
+        self._bs_last = None # (ename, BeamState) of the target element
 
         # update layout drawings
+        self._layout_cache = LayoutCache()
         self.update_layout.connect(self.draw_layout)
         self.show_layout_drawing.connect(self.on_show_layout_drawings)
+        self._eng_drawing = None # name of the drawing to show, see ENG_DRAWING_MAP
+        self.tabWidget.currentChanged.connect(self.on_tab_changed)
         # lattice changed
         self.lattice_changed.connect(self.on_lattice_changed)
 
@@ -202,6 +285,12 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         self.mticks_on_chkbox.toggled.connect(self.on_mticks_enabled)
         self.tight_layout_on_chkbox.toggled.connect(self.on_tightlayout_enabled)
 
+        # ellipse drawings, axes styles are only applied when changed
+        self.__init_ellipse_plots()
+        self.on_grid_enabled(self.grid_on_chkbox.isChecked())
+        self.on_mticks_enabled(self.mticks_on_chkbox.isChecked())
+        self.on_tightlayout_enabled(self.tight_layout_on_chkbox.isChecked())
+
         # preload default machine/segment
         # self.__preload_lattice(DEFAULT_MACHINE, DEFAULT_SEGMENT)
 
@@ -248,21 +337,18 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         # update selected diag_elements and dataviz.
         # print("Selected diag devices:")
         if d is not None:
-            self._diag_elems[category] = [self.__lat[i] for i in d]
+            self._engine.select_diags(category, d)
 
-        if len(self._diag_elems[category]) == 0:
-            return
+        # s, x0, y0 or s, rx, ry
+        self._emit_diag_data(category, self._engine.diag_data(category))
 
-        flds = DIAG_FLD_MAP[category]
-        diag_data = np.asarray(
-                [[getattr(elem, fld) for fld in flds] for elem in self._diag_elems[category]])
-        col1 = diag_data[:, 0] + self.__z0 # s
-        col2 = diag_data[:, 1] * 1e3 # x0 or rx, m -> mm
-        col3 = diag_data[:, 2] * 1e3 # y0 or ry, m -> mm
+    def _emit_diag_data(self, category, diag_data):
+        if diag_data is None:
+            return
         if category == 'trajectory':
-            self.diag_data_updated1.emit((col1, col2, col3))
+            self.diag_data_updated1.emit(diag_data)
         elif category == 'envelope':
-            self.diag_data_updated2.emit((col1, col2, col3))
+            self.diag_data_updated2.emit(diag_data)
 
     @pyqtSlot()
     def on_select_devices(self, category, dtype_list):
@@ -273,6 +359,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
                                 "Cannot find loaded lattice, load by clicking 'Load Lattice' or Ctrl+Shift+L.",
                                 QMessageBox.Ok)
             return
+        from phantasy_ui.widgets import ElementSelectionWidget
         w = self._elem_sel_widgets.setdefault(category,
                                               ElementSelectionWidget(self, self.__mp, dtypes=dtype_list))
         w.elementsSelected.connect(partial(self.on_update_elems, category))
@@ -298,6 +385,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     def on_update_elems(self, category, enames):
         """Selected element names list updated, mode: 'envelope'/'trajectory'
         """
+        from phantasy_apps.trajectory_viewer.utils import ElementListModel
         tv = getattr(self, "{}_diags_treeView".format(category))
         model = ElementListModel(tv, self.__mp, enames)
         # list of fields of selected element type
@@ -329,6 +417,8 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         o.add_curve()
         s = MatplotlibCurveWidgetSettings(str(ENVELOPE_MPL_CONF_PATH))
         o.apply_mpl_settings(s)
+        # lines: x/y rms from model, x/y rms from diags
+        self._envelope_updater = BlitUpdater(o, (0, 1, 2, 3), self._engine.timer)
 
     def __init_trajectory_plot(self):
         """Initialize plot area for beam trajectory.
@@ -339,6 +429,19 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         o.add_curve()
         s = MatplotlibCurveWidgetSettings(str(TRAJECTORY_MPL_CONF_PATH))
         o.apply_mpl_settings(s)
+        # lines: x/y centroid from model, x/y centroid from diags
+        self._trajectory_updater = BlitUpdater(o, (0, 1, 2, 3), self._engine.timer)
+
+    def __init_ellipse_plots(self):
+        """Initialize plot areas for x and y beam ellipses.
+        """
+        self._ellipse_artists = {}
+        for o, xoy, color, fill in ((self.x_ellipse_plot, 'x', 'b', 'g'),
+                                    (self.y_ellipse_plot, 'y', 'r', 'm')):
+            o.setFigureXlabel(f"{xoy} [mm]")
+            o.setFigureYlabel(f"{xoy}' [mrad]")
+            self._ellipse_artists[xoy] = EllipseArtist(o.axes, color=color, fill=fill)
+            time_renders(o.figure.canvas, self._engine.timer)
 
     @pyqtSlot(dict)
     def on_beam_source_updated(self, src_conf):
@@ -376,7 +479,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         # 1. refresh the field name list combobox
         # 2. set field name cbb with the first item
 
-        self.elem_selected = self.__mp.get_elements(name=name)[0]
+        self.elem_selected = self._engine.index.get(name)
         self.field_name_cbb.currentTextChanged.disconnect()
         self.field_name_cbb.clear()
         self.field_name_cbb.addItems(self.elem_selected.fields)
@@ -388,27 +491,36 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     @pyqtSlot(float)
     def on_new_cset_changed(self, val: float) -> None:
         """When the setting of the selected element/field is changed, do:
-        1. print the setting of selected element/field
-        2. update drawing with online simulated results
+        1. set the selected element/field when no more change comes in the
+           settle window, only the last value is set
+        2. update drawing with online simulated results (once)
         """
-        self.fld_selected.value = val
-
-        # update online model (once)
-        self.actionUpdate.triggered.emit()
+        self._cset_coalescer.push(self.fld_selected, val)
+        if self.actionLinear_Preview.isChecked():
+            self.preview_setting(self.elem_selected.name, self.fld_selected.name, val)
+
+    def preview_setting(self, ename, fname, val):
+        """Show the results of the linearized model with the setting of
+        *fname* of *ename* changed to *val*, nothing is shown if the change is
+        too large, the full run follows anyway.
+        """
+        r = self._engine.linear_update({(ename, fname): val}, self._target_ename)
+        if r is None:
+            return
+        data1, twiss = r
+        self.data_updated1.emit(data1)
+        if twiss is not None:
+            self.data_updated2.emit(*twiss)
 
     @pyqtSlot(tuple)
     def on_update_diag_data1(self, t1):
         s, x0, y0 = t1
-        for line_id, ucen in zip((2, 3), (x0, y0)):
-            self.trajectory_plot.setLineID(line_id)
-            self.trajectory_plot.update_curve(s, ucen)
+        self._trajectory_updater.set_data({2: (s, x0), 3: (s, y0)})
 
     @pyqtSlot(tuple)
     def on_update_diag_data2(self, t2):
         s, rx, ry = t2
-        for line_id, urms in zip((2, 3), (rx, ry)):
-            self.envelope_plot.setLineID(line_id)
-            self.envelope_plot.update_curve(s, urms)
+        self._envelope_updater.set_data({2: (s, rx), 3: (s, ry)})
 
     @pyqtSlot(tuple)
     def on_update_data1(self, t1):
@@ -424,36 +536,22 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     def draw_envelope(self, pos, xrms, yrms):
         """Draw beam envelop onto the figure area.
         """
-        for line_id, urms in zip((0, 1), (xrms, yrms)):
-            self.envelope_plot.setLineID(line_id)
-            self.envelope_plot.update_curve(pos, urms)
+        self._envelope_updater.set_data({0: (pos, xrms), 1: (pos, yrms)})
 
     def draw_trajectory(self, pos, xcen, ycen):
         """Draw beam centroid trajectory onto the figure area.
         """
-        for line_id, ucen in zip((0, 1), (xcen, ycen)):
-            self.trajectory_plot.setLineID(line_id)
-            self.trajectory_plot.update_curve(pos, ucen)
+        self._trajectory_updater.set_data({0: (pos, xcen), 1: (pos, ycen)})
 
     @pyqtSlot()
     def draw_ellipse(self):
         """Draw x and y beam ellipse onto the figure area.
         """
         params_x, params_y = self.params_x, self.params_y
-        self._plot_ellipse(self.x_ellipse_plot,
-                           params_x,
-                           color='b',
-                           factor=self._size_factor,
-                           xoy='x',
-                           fill='g',
-                           anote=False)
-        self._plot_ellipse(self.y_ellipse_plot,
-                           params_y,
-                           color='r',
-                           factor=self._size_factor,
-                           xoy='y',
-                           fill='m',
-                           anote=False)
+        for o, xoy, params in ((self.x_ellipse_plot, 'x', params_x),
+                               (self.y_ellipse_plot, 'y', params_y)):
+            self._ellipse_artists[xoy].update(params, xoy, self._size_factor)
+            o.figure.canvas.draw_idle()
         #
         params = {k: v for k, v in params_x.items()}
         params.update(params_y)
@@ -461,33 +559,15 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         self._show_results(data)
 
 
-    def _plot_ellipse(self, figure_obj, params, **kws):
-        xoy = kws.get('xoy', 'x')
-        xlbl = f"{xoy} [mm]"
-        ylbl = f"{xoy}' [mrad]"
-        figure_obj.clear_figure()
-        draw_beam_ellipse_with_params(params,
-                                      ax=figure_obj.axes,
-                                      color=kws.get('color', 'b'),
-                                      factor=kws.get('factor', 4),
-                                      xoy=xoy,
-                                      fill=kws.get('fill', 'g'),
-                                      anote=kws.get('anote', False))
-        figure_obj.setFigureXlabel(xlbl)
-        figure_obj.setFigureYlabel(ylbl)
-        figure_obj.update_figure()
-        self.on_xlimit_changed('')
-        self.on_ylimit_changed('')
-        self.grid_on_chkbox.toggled.emit(self.grid_on_chkbox.isChecked())
-        self.mticks_on_chkbox.toggled.emit(self.mticks_on_chkbox.isChecked())
-        self.tight_layout_on_chkbox.toggled.emit(self.tight_layout_on_chkbox.isChecked())
-
     def draw_layout(self):
+        # draw once per machine/segment, shared by all the layout panels.
+        key = (self.__mp.last_machine_name, self.__mp.last_lattice_name)
+        layout = self._layout_cache.get(key, lambda ax, fig:
+                    self.__lat.layout.draw(ax=ax, fig=fig, span=(1.05, 1.1)))
         for o in (self.layout_plot, self.envelope_layout_plot, self.trajectory_layout_plot):
             o.clear_figure()
-            _, ax = self.__lat.layout.draw(ax=o.axes, fig=o.figure,
-                                           span=(1.05, 1.1),
-                                           fig_opt={'figsize': (20, 8), 'dpi': 130})
+            layout.attach(o.axes)
+            o.figure.canvas.draw_idle()
         self.envelope_plot_splitter.setStretchFactor(0, 4)
         self.envelope_plot_splitter.setStretchFactor(1, 1)
         self.trajectory_plot_splitter.setStretchFactor(0, 4)
@@ -497,14 +577,25 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     def on_target_element_changed(self, ename: str):
         """Get beam state result after the selected element from FLAME model.
         """
-        elem = self.__lat[ename]
+        elem = self._engine.index.get(ename)
+        self._target_ename = ename
         self.family_lineEdit.setText(elem.family)
         self.pos_lineEdit.setText(f"{elem.sb + self.__z0:.3f} m")
         delayed_exec(self.actionUpdate.triggered.emit, 1000)
 
     def _show_results(self, data):
-        m = ResultsModel(self.twiss_results_treeView, data)
-        m.set_model()
+        with self._engine.timer.stage('table_refresh'):
+            self._results_model.set_data(data)
+
+    @pyqtSlot()
+    def on_set_twiss_reference(self):
+        """Use the current Twiss parameters as the reference (v1).
+        """
+        self._results_model.set_reference(self._results_model.current_values())
+
+    @pyqtSlot()
+    def on_clear_twiss_reference(self):
+        self._results_model.set_reference({})
 
     @pyqtSlot()
     def on_probe_elem(self):
@@ -518,12 +609,13 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     def on_probe_target_elem(self):
         """Pop up dialog for selected target element for info query.
         """
-        elem = self.__lat[self.elemlist_cbb.currentText()]
+        elem = self._engine.index.get(self.elemlist_cbb.currentText())
         self.__probe_element(elem)
 
     def __probe_element(self, elem, fname=None):
         ename = elem.name
         if ename not in self._probe_widgets_dict:
+            from phantasy_ui.widgets import ProbeWidget
             w = ProbeWidget(element=elem, detached=False)
             self._probe_widgets_dict[ename] = w
         w = self._probe_widgets_dict[ename]
@@ -615,6 +707,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         """Load machine/segment.
         """
         if self.lattice_load_window is None:
+            from phantasy_ui.widgets import LatticeWidget
             self.lattice_load_window = LatticeWidget()
             self.lattice_load_window.latticeChanged.connect(self.lattice_changed)
             self.lattice_load_window.latticeChanged.connect(
@@ -625,9 +718,20 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     def on_lattice_changed(self, mp):
         """A new machine/segment is loaded.
         """
+        self.stop_recording()
+        self._engine.set_lattice(mp)
+        if self._scan_widget is not None:
+            self._scan_widget.close()
+            self._scan_widget = None
+        if self._fit_widget is not None:
+            self._fit_widget.close()
+            self._fit_widget = None
+        if self._response_widget is not None:
+            self._response_widget.close()
+            self._response_widget = None
         self.__mp = mp
-        self.__lat = mp.work_lattice_conf
-        self.__z0 = self.__lat.layout.z
+        self.__lat = self._engine.lat
+        self.__z0 = self._engine.z0
 
         #
         if self.__mp.last_machine_name in ('ARIS', 'ARIS_VA',):
@@ -639,7 +743,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         # update element type cbb,
         self.elem_type_cbb.currentTextChanged.disconnect()
         self.elem_type_cbb.clear()
-        dtype_list = list(set([i.family for i in self.__lat if i.family in VALID_ELEMENT_TYPES]))
+        dtype_list = [i for i in self._engine.index.families if i in VALID_ELEMENT_TYPES]
         self.elem_type_cbb.addItems(dtype_list)
         if DEFAULT_ELEMENT_TYPE in dtype_list:
             self.elem_type_cbb.setCurrentText(DEFAULT_ELEMENT_TYPE)
@@ -649,7 +753,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         self.elem_type_cbb.currentTextChanged.emit(self.elem_type_cbb.currentText())
 
         # update element list (at which view results)
-        ename_list = [i.name for i in self.__lat]
+        ename_list = self._engine.index.names
         self.elemlist_cbb.currentTextChanged.disconnect()
         self.elemlist_cbb.addItems(ename_list)
         self.elemlist_cbb.currentTextChanged.connect(self.on_target_element_changed)
@@ -696,7 +800,7 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         # 2. Set element list combobox with the first item
         self.elem_name_cbb.currentTextChanged.disconnect()
         self.elem_name_cbb.clear()
-        self.elem_name_cbb.addItems([i.name for i in self.__mp.get_elements(type=dtype)])
+        self.elem_name_cbb.addItems([i.name for i in self._engine.index.by_family(dtype)])
         self.elem_name_cbb.setCurrentIndex(0)
         self.elem_name_cbb.currentTextChanged.connect(self.on_elem_name_changed)
         self.elem_name_cbb.currentTextChanged.emit(self.elem_name_cbb.currentText())
@@ -706,111 +810,259 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
         """Auto update simulation.
         """
         if toggled:
-            self._stop_auto_update = False
-            self.start_auto_updater()
+            self.actionMonitor_Update.setChecked(False)
+        self._sim_worker.set_auto(toggled)
+
+    @pyqtSlot(bool)
+    def onMonitorUpdateModel(self, toggled):
+        """Update simulation when any setting is reported changed by the
+        monitors, only the changed elements are synced.
+        """
+        if self._engine.monitor is None:
+            if toggled:
+                QMessageBox.warning(self, "Monitor Update",
+                        "Cannot find loaded lattice, load by clicking 'Load Lattice' or Ctrl+Shift+L.",
+                        QMessageBox.Ok, QMessageBox.Ok)
+                self.actionMonitor_Update.setChecked(False)
+            return
+        if toggled:
+            self.actionAuto_Update.setChecked(False)
+            self._engine.start_monitor()
+            self._sim_worker.submit()
         else:
-            self.stop_auto_updater()
+            self._engine.stop_monitor()
 
-    def stop_auto_updater(self):
-        self._stop_auto_update = True
+    @pyqtSlot()
+    def onShowTiming(self):
+        """Show the durations of the update stages.
+        """
+        if self._timing_widget is None:
+            self._timing_widget = TimingWidget(self._engine.timer)
+        self._timing_widget.show()
+        self._timing_widget.raise_()
 
-    def start_auto_updater(self):
-        if self._stop_auto_update:
+    @pyqtSlot()
+    def on_refresh_timing(self):
+        s = self._engine.timer.summary()
+        self._timing_label.setText(f"Timing (p50, ms) {s}" if s else "")
+
+    @pyqtSlot()
+    def onParameterScan(self):
+        """Scan the selected element/field with the model in parallel.
+        """
+        if self._engine.session is None or self._engine.session.fm is None:
+            QMessageBox.warning(self, "Parameter Scan",
+                    "Load lattice and update the model before scanning.",
+                    QMessageBox.Ok, QMessageBox.Ok)
             return
-        self.updater_n = DAQT(daq_func=partial(self.update_single,
-                              self.__lat, self.elemlist_cbb.currentText(), self._update_delt,
-                              self._src_conf),
-                              daq_seq=range(1))
-        self.updater_n.daqStarted.connect(partial(self.set_widgets_status, "START", True))
-        self.updater_n.resultsReady.connect(self.on_updater_results_ready)
-        self.updater_n.finished.connect(partial(self.set_widgets_status, "STOP", True))
-        self.updater_n.finished.connect(self.start_auto_updater)
-        self.updater_n.start()
+        if self._scan_widget is None:
+            self._scan_widget = ScanWidget(self._engine)
+        self._scan_widget.set_params(self.elem_name_cbb.currentText(),
+                                     self.field_name_cbb.currentText(),
+                                     self.elemlist_cbb.currentText())
+        self._scan_widget.show()
+        self._scan_widget.raise_()
+
+    @pyqtSlot()
+    def onFitModel(self):
+        """Fit the model to the readings of the selected diag devices.
+        """
+        if self._engine.session is None or self._engine.session.fm is None:
+            QMessageBox.warning(self, "Fit Model",
+                    "Load lattice and update the model before fitting.",
+                    QMessageBox.Ok, QMessageBox.Ok)
+            return
+        if self._fit_widget is None:
+            self._fit_widget = FitWidget(self._engine)
+            self._fit_widget.fitApplied.connect(self.on_fit_applied)
+        self._fit_widget.show()
+        self._fit_widget.raise_()
+
+    @pyqtSlot()
+    def onResponseMatrix(self):
+        """Compute the response matrices at the selected diag devices.
+        """
+        if self._engine.session is None or self._engine.session.fm is None:
+            QMessageBox.warning(self, "Response Matrix",
+                    "Load lattice and update the model before computing.",
+                    QMessageBox.Ok, QMessageBox.Ok)
+            return
+        if self._response_widget is None:
+            self._response_widget = ResponseWidget(self._engine)
+        self._response_widget.show()
+        self._response_widget.raise_()
+
+    @pyqtSlot(dict, object)
+    def on_fit_applied(self, settings, src_conf):
+        """Update the model with the fitted element *settings* (no PV writes)
+        and beam source, the element settings are kept until the next sync
+        from the machine.
+        """
+        if self.actionAuto_Update.isChecked():
+            self.actionAuto_Update.setChecked(False)
+        self._engine.apply_settings(settings)
+        if src_conf is not None:
+            self._src_conf = dict(self._src_conf or {}, **src_conf)
+        self._skip_sync = True
+        self._sim_worker.submit()
 
     @pyqtSlot(float)
     def on_update_rate(self, x):
-        self._update_delt = 1.0 / x # second
-
-    def _sim_is_running(self):
-        try:
-            r = self.updater.isRunning()
-        except:
-            r = False
-        finally:
-            return r
+        self._sim_worker.interval = 1.0 / x # second
 
     @pyqtSlot()
     def onUpdateModel(self):
         """Update simulation.
         """
-        if self._sim_is_running():
-            return
-        self.updater = DAQT(daq_func=partial(self.update_single,
-                            self.__lat, self.elemlist_cbb.currentText(), 0,
-                            self._src_conf),
-                            daq_seq=range(1))
-        self.updater.daqStarted.connect(partial(self.set_widgets_status, "START", False))
-        self.updater.resultsReady.connect(self.on_updater_results_ready)
-        self.updater.finished.connect(partial(self.set_widgets_status, "STOP", False))
-        self.updater.start()
-
-    def update_single(self, lat, target_ename, delt, src_conf, iiter):
-        # src_conf: initial beam source configuration.
-        t0 = time.time()
-        lat.sync_settings()
-        _, fm = lat.run(src_conf)
-        results, _ = fm.run(monitor='all')
-        r, _ = fm.run(monitor=[target_ename])
-        if delt > 0:
-            dt = time.time() - t0
-            if delt - dt > 0:
-                time.sleep(delt - dt)
-            else:
-                print(f"Update rate is: {1.0 / dt:.1f} Hz")
-        return results, r, fm
-
+        self._sim_worker.submit()
+
+    def _simulate(self, tick=None):
+        # run in the simulation worker, with the current parameters, or the
+        # recorded settings of the replayed *tick*.
+        if self._engine.session is None:
+            return None
+        if tick is not None:
+            settings = {}
+            for (ename, fname), v in tick['settings'].items():
+                if ename in self._engine.index and np.isfinite(v):
+                    settings.setdefault(ename, {})[fname] = float(v)
+            self._engine.apply_settings(settings)
+        # replay or fitted: run with the model settings, no CA access
+        sync = tick is None and not self._skip_sync
+        self._skip_sync = False
+        with self._engine.timer.stage('simulate'):
+            return self._engine.simulate(self._target_ename, self._src_conf,
+                                         sync=sync) + (tick,)
+
+    @pyqtSlot(object)
     def on_updater_results_ready(self, res):
-        results, r, fm = res[0]
+        results, r, fm, tick = res
         # pos, xrms, yrms, xcen, ycen, twiss parameters
         self.fm = fm
         # s, x0, y0, rx, ry
-        r1_ = fm.collect_data(results, 'pos', 'xcen', 'ycen', 'xrms', 'yrms')
-        pos = r1_['pos'] + self.__z0
-        xcen, ycen = r1_['xcen'], r1_['ycen']
-        xrms, yrms = r1_['xrms'], r1_['yrms']
-        self.data_updated1.emit((pos, xcen, ycen, xrms, yrms))
+        data1 = self._engine.collect_data(results, fm)
+        self.data_updated1.emit(data1)
+        params = {}
         #
         if r == []:
             QMessageBox.warning(self, "Select Element",
                     "Selected element cannot be located in model, probably for splitable element, select the closest one.",
                     QMessageBox.Ok, QMessageBox.Ok)
         else:
-            self.__update_twiss_params(r)
+            params_x, params_y = self._engine.twiss_params(r[0][-1])
+            params.update(params_x)
+            params.update(params_y)
+            self.data_updated2.emit(params_x, params_y)
             # update beam state info
-            self._bs_widget.ename = self.elemlist_cbb.currentText()
-            self.bs_updated.emit(r[0][-1])
-        # diag viz
-        self.on_update_diag_viz('envelope', None)
-        self.on_update_diag_viz('trajectory', None)
-
-    def __update_twiss_params(self, r):
-        s = r[0][-1]
-        vals_x = (s.xcen, s.xpcen, s.xrms, s.xprms, s.xemittance,
-                  s.xnemittance, s.xtwiss_alpha, s.xtwiss_beta,
-                  (s.xtwiss_alpha**2 + 1) / s.xtwiss_beta, 1)
-        vals_y = (s.ycen, s.ypcen, s.yrms, s.yprms, s.yemittance,
-                  s.ynemittance, s.ytwiss_alpha, s.ytwiss_beta,
-                  (s.ytwiss_alpha**2 + 1) / s.ytwiss_beta, 1)
-        params_x = dict(zip(TWISS_KEYS_X, vals_x))
-        params_y = dict(zip(TWISS_KEYS_Y, vals_y))
-        self.data_updated2.emit(params_x, params_y)
+            self._bs_last = self.elemlist_cbb.currentText(), r[0][-1]
+            if self._bs_widget is not None:
+                self._bs_widget.ename = self._bs_last[0]
+                self.bs_updated.emit(self._bs_last[1])
+        # diag viz, read once for the plots, the residuals and the recording
+        if tick is not None:
+            diags = tick['diag']
+        else:
+            diags = {k: self._engine.diag_data(k) for k in ('envelope', 'trajectory')}
+        for k, v in diags.items():
+            self._emit_diag_data(k, None if v is None else tuple(v))
+        self.update_residuals(data1, diags)
+        #
+        if self._recorder is not None and tick is None:
+            self._recorder.record(snapshot_settings(self._engine.lat.settings),
+                                  data1, self._target_ename, params, diags)
+
+    @pyqtSlot()
+    def onReplay(self):
+        """Play back a recording of the model, live updates are stopped.
+        """
+        if self._replay_widget is None:
+            self._replay_widget = ReplayWidget()
+            self._replay_widget.tickReady.connect(self.on_replay_tick)
+        self.actionAuto_Update.setChecked(False)
+        self.actionMonitor_Update.setChecked(False)
+        self._replay_widget.show()
+        self._replay_widget.raise_()
+
+    @pyqtSlot(int, object)
+    def on_replay_tick(self, i, tick):
+        """Show the recorded results of *tick*, or run the model with the
+        recorded settings if asked and the lattice is loaded.
+        """
+        if self._replay_widget.rerun_model and self._engine.session is not None:
+            self._sim_worker.submit(tick)
+            return
+        data1 = tuple(tick[k] for k in BEAM_KEYS)
+        self.data_updated1.emit(data1)
+        twiss = tick['twiss']
+        if np.isfinite(twiss.get('beta_x', np.nan)):
+            params_x = {k: twiss[k] for k in TWISS_KEYS_X if k in twiss}
+            params_y = {k: twiss[k] for k in TWISS_KEYS_Y if k in twiss}
+            self.data_updated2.emit(params_x, params_y)
+        for k, v in tick['diag'].items():
+            self._emit_diag_data(k, None if v is None else tuple(v))
+        self.update_residuals(data1, tick['diag'], tick['time'])
+
+    def update_residuals(self, data, diags, t=None):
+        """Update the residuals of the diag readings against the model, the
+        RMS residuals are shown on the status bar.
+        """
+        r = self._engine.update_residuals(data, diags, t)
+        self._residual_label.setText(", ".join(
+            f"{k.capitalize()} RMS (mm) X: {v.rms1:.3f}, Y: {v.rms2:.3f}"
+            for k, v in r.items()))
+
+    @pyqtSlot()
+    def onShowResiduals(self):
+        """Show the residuals of the diag readings against the model.
+        """
+        if self._residual_widget is None:
+            self._residual_widget = ResidualWidget(self._engine.residuals)
+        self._residual_widget.show()
+        self._residual_widget.raise_()
+
+    @pyqtSlot(bool)
+    def onRecordModel(self, toggled):
+        """Start/stop recording the model results of every update.
+        """
+        if not toggled:
+            self.stop_recording()
+            return
+        filename, ext = get_save_filename(self,
+                                          caption="Record model results to",
+                                          cdir='.',
+                                          type_filter="HDF5 File (*.h5);;NumPy Data Files (*.npz)")
+        if filename is None:
+            self.actionRecord.setChecked(False)
+            return
+        if filename.endswith('.h5'):
+            try:
+                import h5py
+            except ImportError:
+                QMessageBox.warning(self, "Record Model",
+                        "h5py is not installed, record as NumPy data files (.npz).",
+                        QMessageBox.Ok, QMessageBox.Ok)
+                filename = filename[:-3] + '.npz'
+        meta = {'machine': self.__mp.last_machine_name,
+                'segment': self.__mp.last_lattice_name,
+                'z0': self.__z0} if self.__mp is not None else {}
+        self._recorder = TickRecorder(filename, meta)
+
+    def stop_recording(self):
+        if self._recorder is None:
+            return
+        rec, self._recorder = self._recorder, None
+        rec.stop()
+        print(f"Recorded {rec.count} updates to {rec.filepath}, {rec.dropped} dropped.")
+        if self.actionRecord.isChecked():
+            self.actionRecord.setChecked(False)
 
     def set_widgets_status(self, status, auto_update=False):
         if not auto_update:
             olist1 = (self.actionUpdate, self.actionAuto_Update, )
             olist2 = ()
         else:
-            olist1 = (self.actionUpdate, self.update_rate_dsbox, )
+            # update rate is read by the simulation worker every cycle
+            olist1 = (self.actionUpdate, )
             olist2 = ()
         if status != "START":
             [o.setEnabled(True) for o in olist1]
@@ -823,12 +1075,35 @@ class MyAppWindow(BaseAppForm, Ui_MainWindow):
     def on_show_beamstate(self):
         """Show beam state details.
         """
+        if self._bs_widget is None:
+            from phantasy_ui.widgets import BeamStateWidget
+            self._bs_widget = BeamStateWidget(None, None, None)
+            self.bs_updated.connect(self._bs_widget.bs_updated)
+            self._bs_widget.beam_source_updated[dict].connect(self.on_beam_source_updated)
+            if self._bs_last is not None:
+                self._bs_widget.ename = self._bs_last[0]
+                self.bs_updated.emit(self._bs_last[1])
         self._bs_widget.show()
 
     @pyqtSlot('QString')
     def on_show_layout_drawings(self, name):
-        """Show engineering drawing.
+        """Show engineering drawing, the image is loaded when the tab is opened.
         """
+        self._eng_drawing = name
+        if self.tabWidget.currentWidget() is self.eng_drawing_tab:
+            self.__load_eng_drawing()
+
+    @pyqtSlot(int)
+    def on_tab_changed(self, i):
+        if self.tabWidget.widget(i) is self.eng_drawing_tab:
+            self.__load_eng_drawing()
+
+    def __load_eng_drawing(self):
+        name, self._eng_drawing = self._eng_drawing, None
+        if name is None:
+            return
+        # large images, only registered when needed
+        from .ui import drawings_rc
         self.eng_drawing_browser.setHtml(HTML_TEMPLATE.format(self.ENG_DRAWING_MAP[name]))
 
 
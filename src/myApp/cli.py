@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Run the online model in batch, without GUI.
+
+The lattice is loaded once, then for each input settings file (JSON of
+``{element name: {field name: value}}``), the settings are applied on top of
+the base settings of the model (the loaded ones, or the live ones with
+``--sync``), and the results are written into the output directory:
+
+- <name>.npz: arrays along the lattice, 'pos' [m], 'xcen', 'ycen', 'xrms',
+  'yrms' [mm], 'alpha_x', 'beta_x', 'emit_x', 'alpha_y', 'beta_y', 'emit_y';
+- <name>.json: Twiss parameters at the target element, if ``--target`` is set.
+
+Examples:
+
+>>> online_model_batch --mach ARIS_VA --segm F1 -o out case1.json case2.json
+>>> online_model_batch --mach ARIS_VA --segm F1 --sync --target FS_F1S1:PM_D1052
+"""
+import argparse
+import json
+import pathlib
+import sys
+
+import numpy as np
+
+from .engine import OnlineModelEngine
+from .model import snapshot_settings
+
+# (output key, BeamState attribute)
+TWISS_DATA_KEYS = (
+    ('alpha_x', 'xtwiss_alpha'), ('beta_x', 'xtwiss_beta'), ('emit_x', 'xemittance'),
+    ('alpha_y', 'ytwiss_alpha'), ('beta_y', 'ytwiss_beta'), ('emit_y', 'yemittance'),
+)
+
+
+def read_json(filepath):
+    with open(filepath, 'r') as fp:
+        return json.load(fp)
+
+
+def restore_settings(lat, snapshot):
+    # restore model settings of *lat* from *snapshot* (snapshot_settings()),
+    # the fields added after the snapshot are removed.
+    for ename, flds in lat.settings.items():
+        for fname in [f for f in flds if (ename, f) not in snapshot]:
+            del flds[fname]
+    for (ename, fname), v in snapshot.items():
+        lat.settings[ename][fname] = v
+
+
+def save_results(engine, name, outdir, target_ename=None, src_conf=None):
+    """Run the model with current settings, save the results as *name*.npz
+    (and *name*.json for the target) in *outdir*, return the list of the
+    written file paths.
+    """
+    results, r, fm = engine.simulate(target_ename, src_conf, sync=False)
+    beam = engine.beam_data(results)
+    data = {k: beam[k] for k in ('xcen', 'ycen', 'xrms', 'yrms')}
+    data.update((k, beam[v]) for k, v in TWISS_DATA_KEYS)
+    npz_path = outdir.joinpath(f"{name}.npz")
+    np.savez_compressed(npz_path, pos=beam['pos'] + engine.z0, **data)
+    paths = [npz_path]
+    if target_ename is not None:
+        if r == []:
+            print(f"Cannot locate '{target_ename}' in model, skip Twiss.")
+        else:
+            params_x, params_y = engine.twiss_params(r[0][-1])
+            params = {'element': target_ename, 'x': params_x, 'y': params_y}
+            json_path = outdir.joinpath(f"{name}.json")
+            with open(json_path, 'w') as fp:
+                json.dump(params, fp, indent=2, default=float)
+            paths.append(json_path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Run the online model (FLAME) in batch, without GUI.")
+    parser.add_argument("settings", nargs='*',
+            help="Settings files (JSON) to run one by one, run with the base settings if not set.")
+    parser.add_argument("--mach", dest="machine", default="ARIS_VA",
+            help="Machine name, default is ARIS_VA.")
+    parser.add_argument("--segm", dest="segment", default="F1",
+            help="Segment name, default is F1.")
+    parser.add_argument("--source", dest="source",
+            help="Beam source configuration file (JSON).")
+    parser.add_argument("--target", dest="target",
+            help="Element name to save the Twiss parameters.")
+    parser.add_argument("--sync", action="store_true",
+            help="Read the base settings from the controls environment.")
+    parser.add_argument("-o", "--output", dest="output", default=".",
+            help="Directory for the output files, default is the current one.")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    outdir = pathlib.Path(args.output)
+    outdir.mkdir(parents=True, exist_ok=True)
+    src_conf = None if args.source is None else read_json(args.source)
+
+    engine = OnlineModelEngine()
+    engine.load_lattice(args.machine, args.segment)
+    if args.sync:
+        engine.lat.sync_settings()
+    base = snapshot_settings(engine.lat.settings)
+
+    if not args.settings:
+        cases = [("model", {})]
+    else:
+        cases = [(pathlib.Path(f).stem, read_json(f)) for f in args.settings]
+
+    nfailed = 0
+    for name, settings in cases:
+        restore_settings(engine.lat, base)
+        try:
+            engine.apply_settings(settings)
+            paths = save_results(engine, name, outdir, args.target, src_conf)
+        except Exception as e:
+            nfailed += 1
+            print(f"[{name}] Failed: {e}")
+        else:
+            print(f"[{name}] Saved to {', '.join(str(p) for p in paths)}")
+
+    return 1 if nfailed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Buffered readings of diagnostic devices.
+
+The readback PVs of the selected devices are subscribed once, the monitor
+callbacks keep the received values, and the readings are served from the
+local buffer, no CA call is made when reading.
+"""
+import threading
+from functools import partial
+
+import numpy as np
+
+
+class DiagBuffer(object):
+    """Latest readings of the subscribed device fields, the reading of a field
+    is the mean of the values of its readback PVs (the default read policy),
+    NaN until all of them are received.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._elems = {} # {(ename, fname): CaElement}
+        self._callbacks = {} # {(ename, fname): [(PV, callback index)]}
+        self._pv_values = {} # {(ename, fname): [value of each readback PV]}
+        self._values = {} # {(ename, fname): value}
+
+    def subscribe(self, elems, fields):
+        """Subscribe *fields* (list of str) of each of *elems* (list of CaElement).
+        """
+        for elem in elems:
+            for fname in fields:
+                key = (elem.name, fname)
+                with self._lock:
+                    if key in self._elems:
+                        continue
+                    self._elems[key] = elem
+                fld = elem.get_field(fname)
+                if fld is None:
+                    # static attribute, e.g. 'sb'.
+                    with self._lock:
+                        self._values[key] = getattr(elem, fname)
+                    continue
+                pvs = list(fld.readback_pv)
+                with self._lock:
+                    self._pv_values[key] = [None] * len(pvs)
+                # run now with the last received values of the connected PVs.
+                self._callbacks[key] = [
+                    (pv, pv.add_callback(partial(self._on_change, key, i), run_now=True))
+                    for i, pv in enumerate(pvs)]
+
+    def unsubscribe(self, enames):
+        """Unsubscribe all the fields of elements in *enames*.
+        """
+        enames = set(enames)
+        with self._lock:
+            keys = [k for k in self._elems if k[0] in enames]
+            for key in keys:
+                self._elems.pop(key)
+                self._pv_values.pop(key, None)
+                self._values.pop(key, None)
+        for key in keys:
+            for pv, idx in self._callbacks.pop(key, []):
+                pv.remove_callback(idx)
+
+    def clear(self):
+        """Unsubscribe all.
+        """
+        self.unsubscribe(self.enames)
+
+    @property
+    def enames(self):
+        """Set of subscribed element names.
+        """
+        with self._lock:
+            return {k[0] for k in self._elems}
+
+    def read(self, elems, fields):
+        """Return the buffered readings as an array of the shape
+        (len(elems), len(fields)), NaN for the fields not received yet.
+        """
+        data = np.full((len(elems), len(fields)), np.nan)
+        with self._lock:
+            for i, elem in enumerate(elems):
+                for j, fname in enumerate(fields):
+                    v = self._values.get((elem.name, fname))
+                    if v is not None:
+                        data[i, j] = v
+        return data
+
+    def _on_change(self, key, i, value=None, **kws):
+        # monitor callback of the i-th readback PV of *key*, no CA calls here.
+        if value is None:
+            return
+        with self._lock:
+            values = self._pv_values.get(key)
+            if values is None: # unsubscribed
+                return
+            values[i] = value
+            if all(v is not None for v in values):
+                self._values[key] = float(np.mean(values))
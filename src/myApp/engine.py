@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""GUI-free online model engine: lattice loading, settings sync, simulation,
+Twiss parameters extraction and diagnostic data collection.
+
+>>> from aris_apps.myapp.engine import OnlineModelEngine
+>>> engine = OnlineModelEngine()
+>>> engine.load_lattice("ARIS_VA", "F1")
+>>> results, r, fm = engine.simulate(target_ename="FS_F1S1:PM_D1052")
+>>> pos, xcen, ycen, xrms, yrms = engine.collect_data(results, fm)
+>>> params_x, params_y = engine.twiss_params(r[0][-1])
+"""
+from operator import attrgetter
+
+import numpy as np
+
+from .diag import DiagBuffer
+from .index import LatticeIndex
+from .model import FLAME_PROP_MAP
+from .model import ModelSession
+from .model import SettingsMonitor
+from .residual import ResidualTracker
+from .surrogate import LinearSurrogate
+from .surrogate import within_tolerance
+from .timing import StageTimer
+
+# fields of diag devices for each category
+DIAG_FLD_MAP = {'envelope': ('sb', 'XRMS', 'YRMS'), 'trajectory': ('sb', 'XCEN', 'YCEN')}
+
+# key strings for Twiss X,Y parameters
+TWISS_KEYS_X = [
+    i.format(u='x') for i in ('{u}_cen', '{u}p_cen', '{u}_rms', '{u}p_rms',
+                              'emit_{u}', 'emitn_{u}', 'alpha_{u}', 'beta_{u}',
+                              'gamma_{u}', 'total_intensity')
+]
+TWISS_KEYS_Y = [
+    i.format(u='y') for i in ('{u}_cen', '{u}p_cen', '{u}_rms', '{u}p_rms',
+                              'emit_{u}', 'emitn_{u}', 'alpha_{u}', 'beta_{u}',
+                              'gamma_{u}', 'total_intensity')
+]
+
+# BeamState attributes collected for all the elements
+BEAM_DATA_KEYS = (
+    'pos', 'xcen', 'ycen', 'xrms', 'yrms', 'xpcen', 'ypcen', 'xprms', 'yprms',
+    'xemittance', 'yemittance', 'xnemittance', 'ynemittance',
+    'xtwiss_alpha', 'xtwiss_beta', 'ytwiss_alpha', 'ytwiss_beta',
+)
+
+
+# columns of (moment0_env, moment0_rms) of BeamState, [mm, rad]
+MOMENT_COLUMNS = {
+    'xcen': ('moment0_env', 0), 'ycen': ('moment0_env', 2),
+    'xrms': ('moment0_rms', 0), 'yrms': ('moment0_rms', 2),
+}
+
+
+class BeamDataBuffer(object):
+    """Preallocated arrays of BeamState attributes (*keys*) of all the
+    elements, filled in one pass over the results, the buffers are reused
+    across the updates.
+
+    The centroid and rms sizes (MOMENT_COLUMNS) are sliced from the moment
+    arrays of each state, read once per state; the other keys are read as
+    attributes.
+
+    Two buffers are used in turn, the arrays returned by :meth:`fill` are
+    valid until the next but one call.
+    """
+    def __init__(self, keys=BEAM_DATA_KEYS, nbuf=2):
+        self.keys = tuple(keys)
+        self._moments = None # names of the moment arrays to read
+        self._attrs = None # names of the attributes to read
+        self._bufs = [{} for _ in range(nbuf)]
+        self._i = 0
+
+    def _init_getter(self, s):
+        # read the moment arrays if BeamState *s* has them.
+        moments = sorted({MOMENT_COLUMNS[k][0] for k in self.keys if k in MOMENT_COLUMNS})
+        if all(hasattr(s, m) for m in moments):
+            self._moments = moments
+            self._attrs = [k for k in self.keys if k not in MOMENT_COLUMNS]
+        else:
+            self._moments, self._attrs = [], list(self.keys)
+        names = self._moments + self._attrs
+        getter = attrgetter(*names)
+        self._getter = getter if len(names) > 1 else lambda s: (getter(s), )
+
+    def fill(self, results):
+        """Return a dict of ``{key: array}`` from *results*, list of
+        (index, BeamState).
+        """
+        n = len(results)
+        if n == 0:
+            return {k: np.empty(0) for k in self.keys}
+        if self._moments is None:
+            self._init_getter(results[0][1])
+        moments, nm = self._moments, len(self._moments)
+
+        self._i = (self._i + 1) % len(self._bufs)
+        buf = self._bufs[self._i]
+        if buf.get('size', 0) < n:
+            # grow with headroom, avoid reallocating for small changes.
+            size = n + n // 4
+            buf.clear()
+            buf['size'] = size
+            buf['attrs'] = np.empty((size, len(self._attrs)))
+            for name in moments:
+                buf[name] = np.empty((size, len(getattr(results[0][1], name))))
+
+        getter = self._getter
+        arrs = [buf[name] for name in moments]
+        attrs = buf['attrs']
+        for i, (_, s) in enumerate(results):
+            vals = getter(s)
+            for a, v in zip(arrs, vals):
+                a[i] = v
+            attrs[i] = vals[nm:]
+
+        r = {k: attrs[:n, j] for j, k in enumerate(self._attrs)}
+        for k in self.keys:
+            if k not in r:
+                name, j = MOMENT_COLUMNS[k]
+                r[k] = buf[name][:n, j]
+        return r
+
+
+def pick_results(results, indices):
+    """Pick up the (index, BeamState) pairs of given element *indices* from
+    the *results* of a FLAME run with monitor='all', keep the order of
+    *indices*, return an empty list if none is found.
+    """
+    states = dict(results)
+    return [(i, states[i]) for i in indices if i in states]
+
+
+def get_twiss_params(s):
+    """Return a tuple of dicts of Twiss X and Y parameters from BeamState *s*.
+    """
+    vals_x = (s.xcen, s.xpcen, s.xrms, s.xprms, s.xemittance,
+              s.xnemittance, s.xtwiss_alpha, s.xtwiss_beta,
+              (s.xtwiss_alpha**2 + 1) / s.xtwiss_beta, 1)
+    vals_y = (s.ycen, s.ypcen, s.yrms, s.yprms, s.yemittance,
+              s.ynemittance, s.ytwiss_alpha, s.ytwiss_beta,
+              (s.ytwiss_alpha**2 + 1) / s.ytwiss_beta, 1)
+    return dict(zip(TWISS_KEYS_X, vals_x)), dict(zip(TWISS_KEYS_Y, vals_y))
+
+
+class OnlineModelEngine(object):
+    """Online model of one machine/segment, without any GUI.
+
+    Parameters
+    ----------
+    on_settings_changed : callable
+        Called (without arguments, from the CA threads) when any setting is
+        reported changed in the monitor mode, see :meth:`start_monitor`.
+    """
+    def __init__(self, on_settings_changed=None):
+        self.on_settings_changed = on_settings_changed
+        self.mp = None
+        self.lat = None
+        self.index = None # LatticeIndex
+        self.z0 = 0.0
+        self.session = None # ModelSession
+        self.monitor = None # SettingsMonitor
+        self.diag = DiagBuffer()
+        self.diag_elems = {k: [] for k in DIAG_FLD_MAP} # list of CaElement
+        self.timer = StageTimer() # durations of the update stages
+        self._beam_data = {} # {keys: BeamDataBuffer}
+        self.residuals = ResidualTracker() # model vs diag readings
+        self._results = None # results of the last full run
+        self._surrogate = None # (results, LinearSurrogate)
+
+    def load_lattice(self, machine, segment):
+        """Load *machine*/*segment* and return the MachinePortal.
+        """
+        from phantasy import MachinePortal
+        mp = MachinePortal(machine, segment)
+        self.set_lattice(mp)
+        return mp
+
+    def set_lattice(self, mp):
+        """Work with the loaded machine/segment of MachinePortal *mp*.
+        """
+        monitored = self.monitor is not None and self.monitor.active
+        if monitored:
+            self.monitor.stop()
+        self.mp = mp
+        self.lat = mp.work_lattice_conf
+        self.z0 = self.lat.layout.z
+        self.index = LatticeIndex(self.lat)
+        self.session = ModelSession(self.lat, self.timer, self.index)
+        self.monitor = SettingsMonitor(self.lat, self._on_settings_changed, self.index)
+        if monitored:
+            self.monitor.start()
+        self.diag.clear()
+        self.diag_elems = {k: [] for k in DIAG_FLD_MAP}
+        self.residuals.clear()
+        self._results = self._surrogate = None
+
+    def start_monitor(self):
+        """Sync the settings only when they are reported changed.
+        """
+        self.monitor.start()
+
+    def stop_monitor(self):
+        """Sync all the settings for every simulation.
+        """
+        self.monitor.stop()
+
+    def _on_settings_changed(self):
+        if self.on_settings_changed is not None:
+            self.on_settings_changed()
+
+    def apply_settings(self, settings):
+        """Update the model settings (no PV writes) with *settings*, a dict of
+        ``{element name: {field name: value}}``.
+        """
+        for ename, flds in settings.items():
+            if ename not in self.lat.settings:
+                raise KeyError(f"Element '{ename}' has no settings in the model.")
+            self.lat.settings[ename].update(flds)
+
+    def simulate(self, target_ename=None, src_conf=None, sync=True):
+        """Sync the settings and run the model.
+
+        Parameters
+        ----------
+        target_ename : str
+            Name of the element to pick up the beam state.
+        src_conf : dict
+            Initial beam source configuration.
+        sync : bool
+            If False, run with the current model settings, no CA access.
+
+        Returns
+        -------
+        r : tuple
+            Tuple of ``(results, r, fm)``, *results* is a list of (index, BeamState)
+            of all the elements, *r* is the one of *target_ename*, *fm* is ModelFlame.
+        """
+        dirty = None
+        if not sync:
+            dirty = ()
+        elif self.monitor.active:
+            dirty = self.monitor.pop_dirty()
+        results, fm = self.session.run(src_conf, dirty)
+        self._results = results
+        r = [] if target_ename is None else \
+            pick_results(results, self.session.find(target_ename))
+        return results, r, fm
+
+    def linear_update(self, settings, target_ename=None):
+        """Evaluate the model with *settings* changed from the last full run
+        by the linear surrogate, without running the whole model.
+
+        Parameters
+        ----------
+        settings : dict
+            ``{(element name, field name): value}`` of the changed settings.
+        target_ename : str
+            Name of the element to get the Twiss parameters.
+
+        Returns
+        -------
+        r : tuple
+            Tuple of (pos, xcen, ycen, xrms, yrms) as :meth:`collect_data`,
+            and the tuple of dicts of Twiss X and Y parameters at
+            *target_ename* (None if not set); None if the settings are changed
+            out of the tolerance, or the model is being updated, a full run is
+            required then.
+        """
+        results, session = self._results, self.session
+        if results is None or session is None:
+            return None
+        with self.timer.stage('linear_update'):
+            for (ename, fname), v in settings.items():
+                prop = FLAME_PROP_MAP.get((getattr(self.index.get(ename), 'family', None),
+                                           fname))
+                v0 = session.settings.get((ename, fname))
+                if prop is None or v0 is None or not within_tolerance(prop, v0, v):
+                    return None
+            if self._surrogate is None or self._surrogate[0] is not results:
+                self._surrogate = (results, LinearSurrogate(results))
+            sur = self._surrogate[1]
+            if not sur.valid:
+                return None
+            transmats = session.element_transmats(settings, results)
+            if transmats is None:
+                return None
+            target = None
+            if target_ename is not None:
+                indices = [i for i in session.find(target_ename) if i in sur.indices]
+                target = indices[-1] if indices else None
+            beam, state = sur.evaluate(transmats, target)
+            twiss = None if state is None else get_twiss_params(state)
+        return (sur.pos + self.z0, beam['xcen'], beam['ycen'], beam['xrms'],
+                beam['yrms']), twiss
+
+    def beam_data(self, results, keys=BEAM_DATA_KEYS):
+        """Return a dict of arrays of BeamState attributes *keys* from the
+        *results* of :meth:`simulate`, the arrays are reused by the next but
+        one call with the same *keys*.
+        """
+        keys = tuple(keys)
+        if keys not in self._beam_data:
+            self._beam_data[keys] = BeamDataBuffer(keys)
+        with self.timer.stage('collect_data'):
+            return self._beam_data[keys].fill(results)
+
+    def collect_data(self, results, fm=None):
+        """Return a tuple of arrays of (pos, xcen, ycen, xrms, yrms) from the
+        *results* of :meth:`simulate`, pos is shifted to the segment start.
+        """
+        r = self.beam_data(results, ('pos', 'xcen', 'ycen', 'xrms', 'yrms'))
+        return r['pos'] + self.z0, r['xcen'], r['ycen'], r['xrms'], r['yrms']
+
+    def twiss_params(self, state):
+        """Return a tuple of dicts of Twiss X and Y parameters of *state*.
+        """
+        with self.timer.stage('twiss'):
+            return get_twiss_params(state)
+
+    def update_residuals(self, data, diags, t=None):
+        """Update the residuals of the diag readings against the model.
+
+        Parameters
+        ----------
+        data : tuple
+            Arrays of (pos, xcen, ycen, xrms, yrms), see :meth:`collect_data`.
+        diags : dict
+            ``{category: (s, u1, u2) or None}``, see :meth:`diag_data`.
+
+        Returns
+        -------
+        r : dict
+            ``{category: Residuals}`` of the categories with diag readings.
+        """
+        pos, xcen, ycen, xrms, yrms = data
+        model = {'envelope': (pos, xrms, yrms), 'trajectory': (pos, xcen, ycen)}
+        r = {}
+        with self.timer.stage('residual'):
+            for category, diag in diags.items():
+                if diag is None:
+                    continue
+                names = [e.name for e in self.diag_elems[category]]
+                if len(names) != len(diag[0]):
+                    names = None # replayed readings
+                r[category] = self.residuals.update(category, model[category],
+                                                    diag, names, t)
+        return r
+
+    def select_diags(self, category, enames):
+        """Select diag devices of *category* ('envelope' or 'trajectory') by
+        the list of element names, readbacks are subscribed.
+        """
+        self.diag_elems[category] = [self.index.get(i) for i in enames]
+        self.diag.subscribe(self.diag_elems[category], DIAG_FLD_MAP[category])
+        # drop the subscriptions of deselected elements
+        in_use = {e.name for elems in self.diag_elems.values() for e in elems}
+        self.diag.unsubscribe(self.diag.enames - in_use)
+
+    def diag_data(self, category):
+        """Return a tuple of arrays of (s [m], u1 [mm], u2 [mm]) of selected
+        diag devices of *category*, u1, u2 are (XRMS, YRMS) for 'envelope',
+        (XCEN, YCEN) for 'trajectory'; return None if nothing is selected.
+        """
+        elems = self.diag_elems[category]
+        if len(elems) == 0:
+            return None
+        with self.timer.stage('diag_read'):
+            data = self.diag.read(elems, DIAG_FLD_MAP[category])
+        return data[:, 0] + self.z0, data[:, 1] * 1e3, data[:, 2] * 1e3
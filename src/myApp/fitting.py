@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Fit the beam source parameters or the element settings of the model to the
+diag readings.
+
+Levenberg-Marquardt with finite-difference Jacobians, the perturbed models
+and the trial steps of each iteration are evaluated in parallel by a
+ModelPool, which keeps the FLAME models alive through all the iterations.
+Only the model is changed, no PV is written.
+
+>>> measured = {'envelope': (enames, xrms, yrms)} # mm
+>>> fit = ModelFit(engine.session, measured,
+...                [(SOURCE_ENAME, 'xscale'), ("FS_F1S1:Q_D1013", "B2")])
+>>> r = fit.run()
+>>> settings, source = fit.split(r.x)
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from .scan import ModelPool
+from .scan import SOURCE_ENAME
+from .scan import SOURCE_PARAMS
+from .scan import make_knob
+from .scan import source_conf
+
+# BeamState attributes of the diag readings (u1, u2) of each category
+FIT_ATTRS = {'envelope': ('xrms', 'yrms'), 'trajectory': ('xcen', 'ycen')}
+
+# knobs, initial and fitted values, cost of each iteration, number of
+# iterations, model and measured values of the observables
+FitResult = namedtuple('FitResult',
+                       ('knobs', 'x0', 'x', 'cost', 'niter', 'model', 'measured'))
+
+
+class ModelFit(object):
+    """Fit the parameters of the model *session* (ModelSession) to the diag
+    readings.
+
+    Parameters
+    ----------
+    session : ModelSession
+        The model to fit, must be run at least once.
+    measured : dict
+        ``{category: (element names, u1, u2)}``, u1, u2 are the readings [mm]
+        of the BeamState attributes of FIT_ATTRS, NaN ones are skipped.
+    params : list
+        List of (element name, field name) of the fitted parameters, element
+        name of SOURCE_ENAME for the beam source parameters of SOURCE_PARAMS.
+    max_workers : int
+        Number of worker processes, default is the number of CPUs.
+    rel_step : float
+        Relative step of the finite differences.
+    abs_step : float
+        Minimum step of the finite differences.
+    """
+    def __init__(self, session, measured, params, max_workers=None,
+                 rel_step=1e-4, abs_step=1e-6):
+        if not params:
+            raise ValueError("No parameter to fit.")
+        self._session = session
+        self._max_workers = max_workers
+        self._rel_step = rel_step
+        self._abs_step = abs_step
+        self.knobs = [make_knob(session, ename, fname) for ename, fname in params]
+        # the source the fit runs against, as the worker processes
+        self._src0 = dict(session.fm.machine.conf(0))
+        settings = session.lattice.settings
+        self.x0 = np.array([SOURCE_PARAMS[k.fname] if k.ename == SOURCE_ENAME
+                            else settings[k.ename][k.fname] for k in self.knobs],
+                           dtype=float)
+        # observables at the exit of each diag device
+        obs, y = [], []
+        for category, (enames, u1, u2) in measured.items():
+            for ename, v1, v2 in zip(enames, u1, u2):
+                indices = session.find(ename)
+                if not indices:
+                    continue
+                for attr, v in zip(FIT_ATTRS[category], (v1, v2)):
+                    if np.isfinite(v):
+                        obs.append((indices[-1], attr))
+                        y.append(v)
+        if len(obs) < len(self.knobs):
+            raise ValueError(f"Not enough diag readings ({len(obs)}) to fit "
+                             f"{len(self.knobs)} parameters.")
+        self.obs = obs
+        self.measured = np.array(y)
+
+    def split(self, x):
+        """Return a tuple of the model settings, ``{element name: {field name:
+        value}}`` and the beam source properties (dict) of values *x*, the
+        latter is None if no beam source parameter is fitted.
+        """
+        settings, src = {}, {}
+        for k, v in zip(self.knobs, x):
+            if k.ename == SOURCE_ENAME:
+                src[k.fname] = float(v)
+            else:
+                settings.setdefault(k.ename, {})[k.fname] = float(v)
+        if not src:
+            return settings, None
+        return settings, source_conf(self._src0, src)
+
+    def run(self, max_iter=20, tol=1e-6, lam=1e-3, callback=None):
+        """Run the fit.
+
+        Parameters
+        ----------
+        max_iter : int
+            Max number of iterations.
+        tol : float
+            Stop if the relative decrease of the cost, or the relative step of
+            all the parameters is less than *tol*.
+        lam : float
+            Initial damping factor.
+        callback :
+            Called with (iteration, x, cost) after each iteration.
+
+        Returns
+        -------
+        r : FitResult
+            The cost is half of the sum of squared residuals [mm^2].
+        """
+        n = len(self.knobs)
+        x = self.x0.copy()
+        with ModelPool(self._session, self._max_workers) as pool:
+            f = pool.evaluate(self.knobs, x, self.obs)[0]
+            costs = [self._cost(f)]
+            it = 0
+            for it in range(1, max_iter + 1):
+                # Jacobian, one perturbed model per parameter.
+                h = np.maximum(np.abs(x) * self._rel_step, self._abs_step)
+                fp = pool.evaluate(self.knobs, x + np.diag(h), self.obs)
+                J = ((fp - f) / h[:, None]).T
+                r = f - self.measured
+                # damped steps of three damping factors, evaluated at once.
+                A, g = J.T @ J, J.T @ r
+                D = np.diag(np.diag(A)) + np.eye(n) * 1e-12
+                lams = lam * np.array([0.1, 1.0, 10.0])
+                steps = [np.linalg.lstsq(A + l * D, -g, rcond=None)[0] for l in lams]
+                ft = pool.evaluate(self.knobs, [x + dx for dx in steps], self.obs)
+                ct = [self._cost(i) for i in ft]
+                ib = int(np.argmin(ct))
+                if ct[ib] < costs[-1]:
+                    x, f, lam = x + steps[ib], ft[ib], lams[ib]
+                    decrease = (costs[-1] - ct[ib]) / costs[-1]
+                    costs.append(ct[ib])
+                else:
+                    lam *= 100.0
+                    decrease = np.inf
+                if callback is not None:
+                    callback(it, x, costs[-1])
+                small = np.all(np.abs(steps[ib]) <= tol * (np.abs(x) + self._abs_step))
+                if decrease < tol or small or costs[-1] == 0:
+                    break
+        return FitResult(self.knobs, self.x0, x, costs, it, f, self.measured)
+
+    def _cost(self, f):
+        r = f - self.measured
+        if not np.all(np.isfinite(r)):
+            return np.inf
+        return 0.5 * float(r @ r)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Index of the lattice elements, built once when the lattice is loaded.
+
+>>> index = LatticeIndex(lat)
+>>> index.get("FS_F1S1:Q_D1013")
+>>> index.by_family("QUAD")
+>>> index.nearest(10.2) # element closest to sb = 10.2 m
+>>> index.in_range(10.0, 20.0) # elements with sb in [10, 20] m
+"""
+import numpy as np
+
+
+class LatticeIndex(object):
+    """Name, family and position lookups of the elements of *lat*, positions
+    are ``sb`` of the elements, i.e. from the lattice start.
+    """
+    def __init__(self, lat):
+        self._elems = list(lat)
+        self._by_name = {}
+        self._by_family = {}
+        for e in self._elems:
+            self._by_name.setdefault(e.name, e)
+            self._by_family.setdefault(e.family, []).append(e)
+        sb = np.array([e.sb for e in self._elems], dtype=float)
+        self._order = np.argsort(sb, kind='stable')
+        self._sb = sb[self._order]
+
+    def __len__(self):
+        return len(self._elems)
+
+    def __iter__(self):
+        return iter(self._elems)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    @property
+    def names(self):
+        """List of element names, in the lattice order.
+        """
+        return [e.name for e in self._elems]
+
+    @property
+    def families(self):
+        """Sorted list of the element families.
+        """
+        return sorted(self._by_family)
+
+    def get(self, name, default=None):
+        """Return the element of *name*.
+        """
+        return self._by_name.get(name, default)
+
+    def by_family(self, family):
+        """Return the list of elements of *family*, in the lattice order.
+        """
+        return list(self._by_family.get(family, ()))
+
+    def nearest(self, s):
+        """Return the element whose ``sb`` is the closest to *s*.
+        """
+        n = len(self._sb)
+        if n == 0:
+            return None
+        i = int(np.searchsorted(self._sb, s))
+        if i == n or (i > 0 and s - self._sb[i - 1] <= self._sb[i] - s):
+            i -= 1
+        return self._elems[self._order[i]]
+
+    def in_range(self, s0, s1):
+        """Return the list of elements with ``sb`` in [*s0*, *s1*], sorted by
+        ``sb``.
+        """
+        i0 = np.searchsorted(self._sb, s0, side='left')
+        i1 = np.searchsorted(self._sb, s1, side='right')
+        return [self._elems[i] for i in self._order[i0:i1]]
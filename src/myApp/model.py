@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Long-lived FLAME model session for the loaded lattice.
+
+The FLAME machine is built once from the lattice, the following updates only
+reconfigure the elements whose settings are changed, and the propagation is
+resumed from the first element whose upstream settings are changed.
+"""
+import json
+import threading
+from functools import partial
+
+from .index import LatticeIndex
+from .surrogate import transfer_matrix
+from .timing import StageTimer
+
+# (element family, physics field name): FLAME element property name
+FLAME_PROP_MAP = {
+    ('QUAD', 'B2'): 'B2',
+    ('SOL', 'B'): 'B',
+    ('HCOR', 'ANG'): 'theta_x',
+    ('VCOR', 'ANG'): 'theta_y',
+}
+
+
+def snapshot_settings(settings):
+    """Flatten model settings of lattice, i.e. ``lat.settings``, into a dict
+    of ``{(element name, field name): value}``.
+    """
+    return {(ename, fname): v for ename, flds in settings.items()
+                              for fname, v in flds.items()}
+
+
+def diff_settings(s0, s1):
+    """Return a dict of the items of *s1* which are new or different from *s0*,
+    both are generated by :func:`snapshot_settings`.
+    """
+    return {k: v for k, v in s1.items() if k not in s0 or s0[k] != v}
+
+
+def conf_key(conf):
+    """Return a string as the identity of the beam source configuration.
+    """
+    if conf is None:
+        return None
+    return json.dumps(conf, sort_keys=True, default=lambda o: repr(o))
+
+
+class ModelSession(object):
+    """Keep a FLAME machine alive for the lattice *lat*.
+
+    Parameters
+    ----------
+    lat :
+        Working lattice of the loaded machine/segment, e.g. ``mp.work_lattice_conf``.
+    timer : StageTimer
+        Record the durations of 'sync_settings', 'model_build' and 'flame_run'.
+    index : LatticeIndex
+        Index of *lat*, built if not set.
+    """
+    def __init__(self, lat, timer=None, index=None):
+        self._lat = lat
+        self.timer = StageTimer() if timer is None else timer
+        self.index = LatticeIndex(lat) if index is None else index
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drop the FLAME machine and the cached beam states, rebuild at the
+        next update.
+        """
+        self.fm = None
+        self._src_key = None
+        self._settings = {}
+        self._flame_index = None # {name: [FLAME element index]}
+        self._checkpoints = CheckpointCache()
+
+    @property
+    def lattice(self):
+        return self._lat
+
+    @property
+    def settings(self):
+        """Model settings of the last update, ``{(element name, field name): value}``.
+        """
+        return self._settings
+
+    @property
+    def source_key(self):
+        """Identity of the beam source configuration of the model.
+        """
+        return self._src_key
+
+    def update(self, src_conf=None, dirty=None):
+        """Sync the settings from the controls environment, patch the FLAME
+        machine with the changed settings and return the model (ModelFlame).
+
+        Only the settings of elements in *dirty* (names) are synced if it is
+        not None, see :class:`SettingsMonitor`.
+        """
+        with self._lock:
+            with self.timer.stage('sync_settings'):
+                self._sync(dirty)
+            with self.timer.stage('model_build'):
+                return self._apply(snapshot_settings(self._lat.settings), src_conf)
+
+    def run(self, src_conf=None, dirty=None):
+        """Update the model and propagate the beam through the whole lattice,
+        the propagation is resumed from the last unchanged checkpoint.
+
+        Only the settings of elements in *dirty* (names) are synced if it is
+        not None, see :class:`SettingsMonitor`, pass an empty one to run with
+        the current model settings without any CA access.
+
+        Returns
+        -------
+        r : tuple
+            Tuple of ``(results, fm)``, *results* is a list of (index, BeamState)
+            for all the elements, as ``fm.run(monitor='all')``.
+        """
+        with self._lock:
+            with self.timer.stage('sync_settings'):
+                self._sync(dirty)
+            with self.timer.stage('model_build'):
+                fm = self._apply(snapshot_settings(self._lat.settings), src_conf)
+            cache = self._checkpoints
+            keys = self._checkpoint_keys()
+            start = cache.resume_point(keys)
+            with self.timer.stage('flame_run'):
+                if start is None:
+                    results = cache.results
+                elif start == 0:
+                    results, _ = fm.run(monitor='all')
+                else:
+                    bs = cache.state_before(start).clone()
+                    r, _ = fm.run(bmstate=bs, from_element=start, monitor='all')
+                    results = cache.results_before(start) + [(i, s) for i, s in r if i >= start]
+            cache.store(keys, results)
+            return results, fm
+
+    def element_transmats(self, settings, results):
+        """Return a dict of ``{index: transfer matrix}`` of the FLAME elements
+        with *settings*, ``{(element name, field name): value}``, each element
+        is propagated alone from the beam state before it in *results* (of
+        :meth:`run`), the model is kept unchanged.
+
+        Return None if the model is being updated, or any of the settings
+        cannot be applied to the model.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            states = dict(results)
+            m = self.fm.machine
+            r = {}
+            for (ename, fname), v in settings.items():
+                elem = self.index.get(ename)
+                prop = FLAME_PROP_MAP.get((getattr(elem, 'family', None), fname))
+                indices = self.find(ename)
+                if prop is None or not indices:
+                    return None
+                for i in indices:
+                    if i - 1 not in states:
+                        return None
+                    v0 = m.conf(i)[prop]
+                    m.reconfigure(i, {prop: float(v)})
+                    try:
+                        _, s = self.fm.run(bmstate=states[i - 1].clone(),
+                                           from_element=i, to_element=i)
+                    finally:
+                        m.reconfigure(i, {prop: v0})
+                    r[i] = transfer_matrix(s)
+            return r
+        finally:
+            self._lock.release()
+
+    def export_latfile(self, latfile):
+        """Export the current model as a FLAME lattice file *latfile*.
+        """
+        with self._lock:
+            self.fm.generate_latfile(latfile=latfile)
+
+    def _sync(self, dirty):
+        if dirty is None:
+            self._lat.sync_settings()
+            return
+        settings = self._lat.settings
+        for ename in dirty:
+            elem = self.index.get(ename)
+            for fname in settings.get(ename, ()):
+                v = elem.get_field(fname).current_setting()
+                if v is not None:
+                    settings[ename][fname] = v
+
+    def _apply(self, settings, src_conf):
+        src_key = conf_key(src_conf)
+        if self.fm is None or src_key != self._src_key:
+            self._build(src_conf)
+        else:
+            changed = diff_settings(self._settings, settings)
+            if changed and not self._patch(changed):
+                self._build(src_conf)
+        self._src_key = src_key
+        self._settings = settings
+        return self.fm
+
+    def _build(self, src_conf):
+        # full rebuild of the FLAME machine from the lattice.
+        _, self.fm = self._lat.run(src_conf)
+        self._flame_index = None
+
+    def _patch(self, changed):
+        # reconfigure FLAME elements with *changed* settings, return False if
+        # any of the settings cannot be applied without rebuilding.
+        confs = []
+        for (ename, fname), v in changed.items():
+            elem = self.index.get(ename)
+            prop = FLAME_PROP_MAP.get((getattr(elem, 'family', None), fname))
+            indices = self.find(ename)
+            if prop is None or not indices:
+                return False
+            confs.extend((i, {prop: v}) for i in indices)
+        m = self.fm.machine
+        for i, c in confs:
+            m.reconfigure(i, c)
+        return True
+
+    def find(self, ename):
+        """Return a list of FLAME element indices of element *ename*.
+        """
+        if self._flame_index is None:
+            # one pass over the FLAME machine for all the names.
+            m = self.fm.machine
+            self._flame_index = {}
+            for i in range(len(m)):
+                self._flame_index.setdefault(m.conf(i)['name'], []).append(i)
+        return self._flame_index.get(ename, [])
+
+    def _checkpoint_keys(self):
+        # list of (index, key) of the checkpoints, the key of each checkpoint
+        # is chained from the keys of all the upstream ones.
+        base, per_index = [self._src_key], {}
+        for (ename, fname), v in sorted(self._settings.items()):
+            indices = self.find(ename)
+            if not indices:
+                # cannot be located in FLAME, invalidate all the checkpoints.
+                base.append((ename, fname, v))
+            for i in indices:
+                per_index.setdefault(i, []).append((fname, v))
+        k = hash(repr(base))
+        keys = [(0, k)]
+        for i in sorted(per_index):
+            k = hash((k, repr(per_index[i])))
+            keys.append((i, k))
+        return keys
+
+
+class SettingsMonitor(object):
+    """Subscribe the setpoint and readback PVs of the lattice elements with
+    settings, collect the names of the elements reported as changed.
+
+    Parameters
+    ----------
+    lat :
+        Working lattice of the loaded machine/segment.
+    on_change : callable
+        Called without arguments from the monitor callbacks whenever a change
+        is reported, must not do any CA calls.
+    index : LatticeIndex
+        Index of *lat*, built if not set.
+    """
+    def __init__(self, lat, on_change=None, index=None):
+        self._lat = lat
+        self.index = LatticeIndex(lat) if index is None else index
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._callbacks = [] # [(PV, callback index)]
+
+    @property
+    def active(self):
+        return bool(self._callbacks)
+
+    def start(self):
+        """Subscribe all the setting PVs, all elements are reported as changed
+        for the first time.
+        """
+        if self.active:
+            return
+        with self._lock:
+            self._dirty.update(self._lat.settings)
+        for ename, flds in self._lat.settings.items():
+            elem = self.index.get(ename)
+            if elem is None:
+                continue
+            for fname in flds:
+                fld = elem.get_field(fname)
+                if fld is None:
+                    continue
+                for pv in list(fld.setpoint_pv) + list(fld.readback_pv):
+                    cb = partial(self._on_pv_changed, ename)
+                    self._callbacks.append((pv, pv.add_callback(cb)))
+
+    def stop(self):
+        """Unsubscribe all the setting PVs.
+        """
+        for pv, idx in self._callbacks:
+            pv.remove_callback(idx)
+        self._callbacks = []
+        self.pop_dirty()
+
+    def pop_dirty(self):
+        """Return the names of changed elements since the last call.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def _on_pv_changed(self, ename, **kws):
+        with self._lock:
+            self._dirty.add(ename)
+        if self._on_change is not None:
+            self._on_change()
+
+
+class CheckpointCache(object):
+    """Beam states of the last propagation, checkpointed at the elements with
+    settings, each checkpoint is keyed by the hash of all the upstream settings.
+    """
+    def __init__(self):
+        self._keys = []
+        self.results = None
+
+    def resume_point(self, keys):
+        """Return the index of the first element from which the beam should be
+        propagated, 0 means the whole lattice, None means nothing is changed.
+        """
+        if self.results is None:
+            return 0
+        for (i, k0), (_, k1) in zip(keys, self._keys):
+            if k0 != k1:
+                return i
+        if len(keys) != len(self._keys):
+            return 0
+        return None
+
+    def state_before(self, index):
+        """Return the beam state right before the element of *index*.
+        """
+        for i, s in reversed(self.results):
+            if i < index:
+                return s
+
+    def results_before(self, index):
+        """Return the list of (index, BeamState) upstream of element *index*.
+        """
+        return [(i, s) for i, s in self.results if i < index]
+
+    def store(self, keys, results):
+        self._keys = keys
+        self.results = results
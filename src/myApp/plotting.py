@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Fast updates of the figures.
+"""
+import numpy as np
+from matplotlib.collections import PathCollection
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
+
+from PyQt5.QtCore import QTimer
+
+# rescale the axes if data shrinks to this fraction of the view range
+RESCALE_SHRINK_RATIO = 0.6
+
+
+def time_renders(canvas, timer, name='plot_redraw'):
+    """Record the durations of the renders of *canvas* as stage *name* of
+    *timer* (StageTimer), the ones requested by ``draw_idle()`` are timed when
+    they are done in the event loop.
+    """
+    draw = canvas.draw
+    def _draw(*args, **kws):
+        with timer.stage(name):
+            return draw(*args, **kws)
+    canvas.draw = _draw
+
+
+class BlitUpdater(object):
+    """Update the lines of a curve widget (MatplotlibCurveWidget) in batch,
+    the staged line data is drawn once in the next event loop cycle.
+
+    The updated lines are animated, only them are redrawn over the cached
+    background (axes, ticks, labels, etc.) with blitting, the full redraw is
+    only done when the axes have to be rescaled, or the figure is resized.
+
+    Parameters
+    ----------
+    widget : MatplotlibCurveWidget
+        Curve widget to update.
+    line_ids : list
+        Indices of the lines to update.
+    timer : StageTimer
+        If set, record the durations of the redraws (full render or blit)
+        as 'plot_redraw', see :func:`time_renders`.
+    """
+    def __init__(self, widget, line_ids, timer=None):
+        self._timer = timer
+        self._w = widget
+        self._canvas = widget.figure.canvas
+        self._ax = widget.axes
+        self._lines = [widget.get_all_curves()[i] for i in line_ids]
+        self._line_map = dict(zip(line_ids, self._lines))
+        for line in self._lines:
+            line.set_animated(True)
+        self._bg = None
+        self._staged = {}
+        self._scheduled = False
+        self._canvas.mpl_connect('draw_event', self._on_draw)
+        if timer is not None:
+            time_renders(self._canvas, timer)
+
+    def set_data(self, data):
+        """Stage the new line data, *data* is a dict of {line_id: (x, y)}.
+        """
+        self._staged.update(data)
+        if not self._scheduled:
+            self._scheduled = True
+            QTimer.singleShot(0, self.flush)
+
+    def flush(self):
+        """Draw all the staged data now.
+        """
+        self._scheduled = False
+        if not self._staged:
+            return
+        for i, (x, y) in self._staged.items():
+            self._line_map[i].set_data(x, y)
+        self._staged = {}
+        if self._bg is None or self._rescale():
+            # full render in the event loop, timed when done.
+            self._canvas.draw_idle()
+        elif self._timer is None:
+            self._blit()
+        else:
+            with self._timer.stage('plot_redraw'):
+                self._blit()
+
+    def _rescale(self):
+        # rescale the axes if auto scale is on and data does not fit the view,
+        # return True if rescaled.
+        if not self._w.getFigureAutoScale():
+            return False
+        x = [np.asarray(l.get_xdata(), dtype=float) for l in self._lines if l.get_visible()]
+        y = [np.asarray(l.get_ydata(), dtype=float) for l in self._lines if l.get_visible()]
+        x = np.concatenate(x) if x else np.array([])
+        y = np.concatenate(y) if y else np.array([])
+        x, y = x[np.isfinite(x)], y[np.isfinite(y)]
+        if x.size == 0 or y.size == 0:
+            return False
+        fit = True
+        for (lo, hi), v in ((self._ax.get_xlim(), x), (self._ax.get_ylim(), y)):
+            vmin, vmax = v.min(), v.max()
+            if vmin < lo or vmax > hi or vmax - vmin < RESCALE_SHRINK_RATIO * (hi - lo):
+                fit = False
+        if fit:
+            return False
+        # flat data never fits the shrink test, unchanged limits are no rescale.
+        lims = self._ax.get_xlim(), self._ax.get_ylim()
+        self._ax.relim()
+        self._ax.autoscale_view()
+        return (self._ax.get_xlim(), self._ax.get_ylim()) != lims
+
+    def _on_draw(self, event):
+        # full redraw is done (animated lines are excluded), cache background.
+        self._bg = self._canvas.copy_from_bbox(self._w.figure.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
+        for line in self._lines:
+            self._ax.draw_artist(line)
+
+    def _blit(self):
+        self._canvas.restore_region(self._bg)
+        self._draw_lines()
+        self._canvas.blit(self._w.figure.bbox)
+
+
+def ellipse_points(params, xoy='x', factor=4, n=101):
+    """Return the arrays of (u, u') on the beam ellipse of the Twiss parameters
+    *params* (see TWISS_KEYS_X, TWISS_KEYS_Y) in *xoy* plane, the emittance
+    is scaled by *factor*.
+    """
+    u0, up0 = params[f'{xoy}_cen'], params[f'{xoy}p_cen']
+    alpha, beta = params[f'alpha_{xoy}'], params[f'beta_{xoy}']
+    emit = params[f'emit_{xoy}'] * factor
+    t = np.linspace(0, 2 * np.pi, n)
+    u = u0 + np.sqrt(emit * beta) * np.cos(t)
+    up = up0 - np.sqrt(emit / beta) * (alpha * np.cos(t) + np.sin(t))
+    return u, up
+
+
+class EllipseArtist(object):
+    """Beam ellipse on *ax*, the artists are created once and updated with
+    new Twiss parameters.
+    """
+    def __init__(self, ax, color='b', fill='g'):
+        self._outline, = ax.plot([], [], '-', color=color, lw=2)
+        self._center, = ax.plot([], [], '+', color=color, ms=10)
+        self._fill = Polygon(np.zeros((0, 2)), closed=True, fc=fill, ec='none',
+                             alpha=0.4)
+        ax.add_patch(self._fill)
+
+    def update(self, params, xoy='x', factor=4):
+        u, up = ellipse_points(params, xoy, factor)
+        self._outline.set_data(u, up)
+        self._center.set_data([params[f'{xoy}_cen']], [params[f'{xoy}p_cen']])
+        self._fill.set_xy(np.column_stack((u, up)))
+
+
+class LayoutGeometry(object):
+    """Geometry of a lattice layout drawing, captured from the axes drawn by
+    *draw_func(ax, fig)* once, then attached to any axes as lightweight
+    artists: one PathCollection for the patches of each (zorder, hatch), and
+    the lines/texts, all in data coordinates.
+    """
+    def __init__(self, draw_func, figsize=(20, 8), dpi=130):
+        # draw into a scratch figure, no canvas, nothing is rendered.
+        fig = Figure(figsize=figsize, dpi=dpi)
+        ax = fig.add_subplot(111)
+        draw_func(ax, fig)
+        self.patches = {} # {(zorder, hatch): (paths, facecolors, edgecolors, linewidths)}
+        for p in ax.patches:
+            paths, fcs, ecs, lws = self.patches.setdefault(
+                    (p.get_zorder(), p.get_hatch()), ([], [], [], []))
+            paths.append(p.get_path().transformed(p.get_transform() - ax.transData))
+            fcs.append(to_rgba(p.get_facecolor(), p.get_alpha()))
+            ecs.append(to_rgba(p.get_edgecolor(), p.get_alpha()))
+            lws.append(p.get_linewidth())
+        self.lines = []
+        for l in ax.lines:
+            xy = (l.get_transform() - ax.transData).transform(l.get_xydata())
+            self.lines.append((xy, dict(
+                    color=l.get_color(), lw=l.get_linewidth(), ls=l.get_linestyle(),
+                    alpha=l.get_alpha(), zorder=l.get_zorder(), marker=l.get_marker(),
+                    ms=l.get_markersize(), mfc=l.get_markerfacecolor(),
+                    mec=l.get_markeredgecolor(), mew=l.get_markeredgewidth())))
+        self.texts = []
+        for t in ax.texts:
+            xy = (t.get_transform() - ax.transData).transform(t.get_position())
+            self.texts.append((xy, t.get_text(), dict(
+                    fontsize=t.get_fontsize(), fontweight=t.get_fontweight(),
+                    color=t.get_color(), alpha=t.get_alpha(), zorder=t.get_zorder(),
+                    rotation=t.get_rotation(), ha=t.get_ha(), va=t.get_va())))
+        self.xlim, self.ylim = ax.get_xlim(), ax.get_ylim()
+        self.axison = ax.axison
+
+    def attach(self, ax):
+        """Add the layout artists to *ax*.
+        """
+        for (zorder, hatch), (paths, fcs, ecs, lws) in self.patches.items():
+            ax.add_collection(PathCollection(paths, facecolors=fcs, edgecolors=ecs,
+                                             linewidths=lws, hatch=hatch, zorder=zorder),
+                              autolim=False)
+        for xy, kws in self.lines:
+            ax.plot(xy[:, 0], xy[:, 1], **kws)
+        for (x, y), s, kws in self.texts:
+            ax.text(x, y, s, **kws)
+        ax.set_xlim(self.xlim)
+        ax.set_ylim(self.ylim)
+        if not self.axison:
+            ax.set_axis_off()
+
+
+class LayoutCache(object):
+    """Cache of LayoutGeometry, keyed by (machine, segment).
+    """
+    def __init__(self):
+        self._cache = {}
+
+    def get(self, key, draw_func):
+        """Return the LayoutGeometry of *key*, draw with *draw_func* if not
+        cached yet, see :class:`LayoutGeometry`.
+        """
+        if key not in self._cache:
+            self._cache[key] = LayoutGeometry(draw_func)
+        return self._cache[key]
+
+    def clear(self):
+        self._cache.clear()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Record the model results of every update to disk, and read them back.
+
+The ticks are queued (bounded, the new ticks are dropped if the writer cannot
+keep up) and written in chunks by a background thread, into an HDF5 file
+(``.h5``, requires h5py) or a directory of compressed NPZ chunks (``.npz``).
+
+Each tick has:
+
+- time: UNIX timestamp;
+- settings: model settings, columns of 'setting_names' ("element:field");
+- pos, xcen, ycen, xrms, yrms: arrays along the lattice [m, mm];
+- target: name of the target element, twiss: Twiss parameters at the target,
+  columns of 'twiss_keys';
+- diag_envelope, diag_trajectory: (s [m], u1 [mm], u2 [mm]) of the selected
+  diag devices, padded with NaN, the number of devices is in '<name>_n'.
+
+>>> rec = TickRecorder("study.h5")
+>>> rec.record(settings, beam, target, twiss, diag)
+>>> rec.stop()
+>>> data = RecordingReader("study.h5")
+>>> len(data), data.column('xrms').shape
+>>> data.tick(0)['twiss']['beta_x']
+"""
+import json
+import pathlib
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .engine import TWISS_KEYS_X
+from .engine import TWISS_KEYS_Y
+
+# keys of the beam data arrays along the lattice
+BEAM_KEYS = ('pos', 'xcen', 'ycen', 'xrms', 'yrms')
+
+# keys of the Twiss parameters at the target
+TWISS_KEYS = [k for k in TWISS_KEYS_X + TWISS_KEYS_Y if k != 'total_intensity']
+
+# diag device categories
+DIAG_CATEGORIES = ('envelope', 'trajectory')
+
+# max length of the target element name
+TARGET_LEN = 64
+
+_STOP = object()
+
+
+def _format(filepath):
+    return 'h5' if pathlib.Path(filepath).suffix in ('.h5', '.hdf5') else 'npz'
+
+
+def _stack_ticks(ticks, setting_names):
+    # stack the list of tick dicts into a dict of arrays.
+    n = len(ticks)
+    data = {'time': np.array([t['time'] for t in ticks])}
+    data['settings'] = np.array([[t['settings'].get(k, np.nan) for k in setting_names]
+                                 for t in ticks], dtype=float).reshape(n, len(setting_names))
+    for i, k in enumerate(BEAM_KEYS):
+        data[k] = np.stack([t['beam'][i] for t in ticks])
+    data['target'] = np.array([t['target'] for t in ticks], dtype=f'S{TARGET_LEN}')
+    data['twiss'] = np.array([[t['twiss'].get(k, np.nan) for k in TWISS_KEYS]
+                              for t in ticks], dtype=float)
+    for cat in DIAG_CATEGORIES:
+        name = f'diag_{cat}'
+        diags = [t['diag'].get(cat) for t in ticks]
+        counts = np.array([0 if d is None else len(d[0]) for d in diags])
+        arr = np.full((n, 3, max(counts.max(), 1)), np.nan)
+        for i, d in enumerate(diags):
+            if d is not None:
+                arr[i, :, :counts[i]] = d
+        data[name], data[f'{name}_n'] = arr, counts
+    return data
+
+
+class _H5Writer(object):
+    # append chunks into resizable datasets of an HDF5 file.
+    def __init__(self, filepath, meta):
+        import h5py
+        self._f = h5py.File(filepath, 'w')
+        for k, v in meta.items():
+            self._f.attrs[k] = json.dumps(v)
+
+    def write(self, data, chunk_ticks):
+        f = self._f
+        for k, v in data.items():
+            if k not in f:
+                f.create_dataset(k, data=v, maxshape=(None, ) * v.ndim,
+                                 chunks=(chunk_ticks, ) + v.shape[1:],
+                                 compression='gzip')
+                continue
+            ds = f[k]
+            n0 = ds.shape[0]
+            shape = (n0 + v.shape[0], ) + tuple(max(a, b) for a, b in zip(ds.shape[1:], v.shape[1:]))
+            if shape[1:] != ds.shape[1:]:
+                # more diag devices, pad the recorded ticks.
+                old = ds[...]
+                ds.resize(shape)
+                ds[...] = np.nan
+                ds[(slice(0, n0), ) + tuple(slice(0, i) for i in old.shape[1:])] = old
+            else:
+                ds.resize(shape)
+            ds[(slice(n0, None), ) + tuple(slice(0, i) for i in v.shape[1:])] = v
+        f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class _NPZWriter(object):
+    # one compressed NPZ file per chunk in a directory.
+    def __init__(self, dirpath, meta):
+        self._dir = pathlib.Path(dirpath)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        with open(self._dir.joinpath("meta.json"), 'w') as fp:
+            json.dump(meta, fp, indent=2)
+        self._i = 0
+
+    def write(self, data, chunk_ticks):
+        np.savez_compressed(self._dir.joinpath(f"chunk_{self._i:05d}.npz"), **data)
+        self._i += 1
+
+    def close(self):
+        pass
+
+
+class TickRecorder(object):
+    """Record the model ticks into *filepath* in background.
+
+    Parameters
+    ----------
+    filepath : str
+        '.h5' (or '.hdf5') for HDF5, otherwise a directory of NPZ chunks.
+    meta : dict
+        Extra info saved with the recording, e.g. machine and segment names.
+    chunk_ticks : int
+        Number of ticks written at once.
+    max_pending : int
+        Max number of ticks in memory waiting to be written, new ticks are
+        dropped when it is reached, see :attr:`dropped`.
+    """
+    def __init__(self, filepath, meta=None, chunk_ticks=16, max_pending=256):
+        self.filepath = str(filepath)
+        self._meta = {} if meta is None else dict(meta)
+        self._chunk_ticks = chunk_ticks
+        self._q = queue.Queue(maxsize=max_pending)
+        self._setting_names = None
+        self.count = 0 # ticks recorded
+        self.dropped = 0 # ticks dropped
+        self.error = None # exception of the writer thread
+        self._th = threading.Thread(target=self._run, daemon=True)
+        self._th.start()
+
+    def record(self, settings, beam, target, twiss, diag, t=None):
+        """Queue one tick, return False if dropped.
+
+        Parameters
+        ----------
+        settings : dict
+            Model settings, ``{(element name, field name): value}``.
+        beam : tuple
+            Arrays of (pos, xcen, ycen, xrms, yrms), copied.
+        target : str
+            Name of the target element.
+        twiss : dict
+            Twiss parameters at the target element.
+        diag : dict
+            ``{category: (s, u1, u2) or None}``, copied.
+        t : float
+            Timestamp, default is now.
+        """
+        if self.error is not None:
+            return False
+        tick = {'time': time.time() if t is None else t,
+                'settings': {f"{e}:{f}": v for (e, f), v in settings.items()},
+                'beam': [np.array(a, dtype=float) for a in beam],
+                'target': (target or '').encode()[:TARGET_LEN],
+                'twiss': dict(twiss),
+                'diag': {k: None if v is None else np.array(v, dtype=float)
+                         for k, v in diag.items()}}
+        try:
+            self._q.put_nowait(tick)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self):
+        """Write the queued ticks and close the file.
+        """
+        if self._th.is_alive():
+            self._q.put(_STOP)
+            self._th.join()
+
+    def _run(self):
+        writer, pending = None, []
+        while True:
+            try:
+                tick = self._q.get(timeout=1.0)
+            except queue.Empty:
+                tick = None
+            stop = tick is _STOP
+            if tick is not None and not stop:
+                pending.append(tick)
+            # write in chunks, or when idle or stopped.
+            if pending and (stop or tick is None or len(pending) >= self._chunk_ticks):
+                try:
+                    writer = self._write(writer, pending)
+                except Exception as e:
+                    self.error = e
+                    print(f"Recording failed: {e}")
+                    stop = True
+                pending = []
+            if stop:
+                break
+        if writer is not None:
+            writer.close()
+
+    def _write(self, writer, ticks):
+        if writer is None:
+            self._setting_names = sorted(ticks[0]['settings'])
+            meta = dict(self._meta, setting_names=self._setting_names,
+                        twiss_keys=TWISS_KEYS, beam_keys=BEAM_KEYS)
+            cls = _H5Writer if _format(self.filepath) == 'h5' else _NPZWriter
+            writer = cls(self.filepath, meta)
+        writer.write(_stack_ticks(ticks, self._setting_names), self._chunk_ticks)
+        self.count += len(ticks)
+        return writer
+
+
+class RecordingReader(object):
+    """Read a recording of :class:`TickRecorder`.
+    """
+    def __init__(self, filepath):
+        self.filepath = str(filepath)
+        if _format(filepath) == 'h5':
+            import h5py
+            self._f = h5py.File(filepath, 'r')
+            self.meta = {k: json.loads(v) for k, v in self._f.attrs.items()}
+            self._chunks = None
+            self._n = self._f['time'].shape[0]
+        else:
+            d = pathlib.Path(filepath)
+            with open(d.joinpath("meta.json"), 'r') as fp:
+                self.meta = json.load(fp)
+            self._chunks = sorted(d.glob("chunk_*.npz"))
+            self._f = None
+            self._offsets = [0]
+            for p in self._chunks:
+                with np.load(p) as z:
+                    self._offsets.append(self._offsets[-1] + z['time'].shape[0])
+            self._n = self._offsets[-1]
+            self._cache = (None, None) # (chunk index, NpzFile)
+
+    @property
+    def setting_names(self):
+        return self.meta['setting_names']
+
+    def __len__(self):
+        return self._n
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+
+    def column(self, name):
+        """Return the array of *name* of all the ticks.
+        """
+        if self._f is not None:
+            return self._f[name][...]
+        arrs = []
+        for p in self._chunks:
+            with np.load(p) as z:
+                arrs.append(z[name])
+        if name.startswith('diag_') and not name.endswith('_n'):
+            m = max(a.shape[-1] for a in arrs)
+            arrs = [np.pad(a, ((0, 0), (0, 0), (0, m - a.shape[-1])),
+                           constant_values=np.nan) for a in arrs]
+        return np.concatenate(arrs)
+
+    def _get(self, name, i):
+        if self._f is not None:
+            return self._f[name][i]
+        ic = int(np.searchsorted(self._offsets, i, side='right')) - 1
+        if self._cache[0] != ic:
+            self._cache = (ic, dict(np.load(self._chunks[ic])))
+        return self._cache[1][name][i - self._offsets[ic]]
+
+    def tick(self, i):
+        """Return the tick *i* as a dict of 'time', 'settings' (dict of
+        ``{(element name, field name): value}``), BEAM_KEYS arrays, 'target',
+        'twiss' (dict) and 'diag' (``{category: (s, u1, u2) or None}``).
+        """
+        if not 0 <= i < self._n:
+            raise IndexError(f"Tick {i} is out of range [0, {self._n}).")
+        r = {'time': float(self._get('time', i))}
+        r['settings'] = {tuple(k.rsplit(':', 1)): v
+                         for k, v in zip(self.setting_names, self._get('settings', i))}
+        for k in BEAM_KEYS:
+            r[k] = self._get(k, i)
+        r['target'] = self._get('target', i).decode()
+        r['twiss'] = dict(zip(self.meta['twiss_keys'], self._get('twiss', i)))
+        r['diag'] = {}
+        for cat in DIAG_CATEGORIES:
+            n = int(self._get(f'diag_{cat}_n', i))
+            r['diag'][cat] = None if n == 0 else tuple(self._get(f'diag_{cat}', i)[:, :n])
+        return r
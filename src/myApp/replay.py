@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Play back a recording of the model (see recorder.py) in the GUI thread.
+
+>>> player = ReplayPlayer(RecordingReader("study.h5"))
+>>> player.tickReady.connect(on_tick) # (index, tick dict)
+>>> player.speed = 10 # 10x real time, 0 for as fast as possible
+>>> player.play()
+>>> player.step(-1) # pause and go to the previous tick
+"""
+import time
+
+from PyQt5.QtCore import QObject
+from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import pyqtSignal
+
+
+class ReplayPlayer(QObject):
+    """Emit the ticks of *reader* (RecordingReader) with the recorded timing,
+    scaled by :attr:`speed`.
+    """
+    # index, tick (dict)
+    tickReady = pyqtSignal(int, object)
+    # playing or not
+    stateChanged = pyqtSignal(bool)
+
+    def __init__(self, reader, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self._reader = reader
+        self._times = reader.column('time')
+        self._i = -1
+        self._speed = 1.0
+        self._playing = False
+        self._anchor = None # (wall time, recorded time) when playing starts
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._advance)
+
+    def __len__(self):
+        return len(self._times)
+
+    @property
+    def position(self):
+        """Index of the current tick, -1 if nothing is played.
+        """
+        return self._i
+
+    @property
+    def playing(self):
+        return self._playing
+
+    @property
+    def speed(self):
+        """Playback speed, relative to real time, 0 for as fast as possible.
+        """
+        return self._speed
+
+    @speed.setter
+    def speed(self, x):
+        self._speed = max(float(x), 0.0)
+        if self._playing:
+            self._reset_anchor()
+            self._schedule()
+
+    def time_of(self, i):
+        """Return the recorded timestamp of tick *i*.
+        """
+        return float(self._times[i])
+
+    def play(self):
+        if len(self) == 0 or self._playing:
+            return
+        if self._i >= len(self) - 1:
+            self._i = -1
+        self._playing = True
+        self.stateChanged.emit(True)
+        self._reset_anchor()
+        self._schedule()
+
+    def pause(self):
+        if not self._playing:
+            return
+        self._playing = False
+        self._timer.stop()
+        self.stateChanged.emit(False)
+
+    def step(self, n=1):
+        """Pause and move by *n* ticks.
+        """
+        self.pause()
+        self.seek(self._i + n)
+
+    def seek(self, i):
+        """Go to tick *i* and emit it.
+        """
+        if len(self) == 0:
+            return
+        self._i = min(max(int(i), 0), len(self) - 1)
+        self.tickReady.emit(self._i, self._reader.tick(self._i))
+        if self._playing:
+            self._reset_anchor()
+            self._schedule()
+
+    def _reset_anchor(self):
+        t = self._times[max(self._i, 0)]
+        self._anchor = (time.monotonic(), t)
+
+    def _schedule(self):
+        i = self._i + 1
+        if i >= len(self):
+            self.pause()
+            return
+        if self._i < 0 or self._speed == 0:
+            self._timer.start(0)
+            return
+        wall0, t0 = self._anchor
+        due = wall0 + (self._times[i] - t0) / self._speed
+        self._timer.start(max(int((due - time.monotonic()) * 1000), 0))
+
+    def _advance(self):
+        if not self._playing:
+            return
+        self._i += 1
+        self.tickReady.emit(self._i, self._reader.tick(self._i))
+        self._schedule()
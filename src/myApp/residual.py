@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Residuals of the model against the diag readings.
+
+The model arrays along the lattice are interpolated at the positions of all
+the diag devices at once, the residual is (measured - model) of each device,
+the RMS of all the devices is kept in a rolling history.
+
+>>> res = ResidualTracker()
+>>> r = res.update('envelope', (pos, xrms, yrms), (s, rx, ry), names)
+>>> r.rms1, r.rms2 # RMS residuals of x and y [mm]
+>>> t, rms1, rms2 = res.history('envelope')
+"""
+import threading
+import time
+from collections import deque
+from collections import namedtuple
+
+import numpy as np
+
+# residuals of the diag devices of one category, s [m], others [mm]
+Residuals = namedtuple('Residuals', ('names', 's', 'r1', 'r2', 'rms1', 'rms2'))
+
+
+def interp_model(pos, u, s):
+    """Return the model values *u* along *pos* interpolated at positions *s*,
+    NaN outside the model range.
+    """
+    return np.interp(s, pos, u, left=np.nan, right=np.nan)
+
+
+def _rms(r):
+    r = r[np.isfinite(r)]
+    return np.sqrt(np.mean(r * r)) if r.size else np.nan
+
+
+class ResidualTracker(object):
+    """Residuals of each diag category, the last *maxlen* ones are kept.
+    """
+    def __init__(self, maxlen=1000):
+        self._maxlen = maxlen
+        self._lock = threading.Lock()
+        self._latest = {} # category: Residuals
+        self._history = {} # category: deque of (t, rms1, rms2)
+
+    def update(self, category, model, diag, names=None, t=None):
+        """Compute the residuals of *category*.
+
+        Parameters
+        ----------
+        category : str
+            Diag category, e.g. 'envelope' or 'trajectory'.
+        model : tuple
+            Arrays of (pos [m], u1, u2) of the model along the lattice.
+        diag : tuple
+            Arrays of (s [m], u1, u2) of the diag devices, same units as *model*.
+        names : list
+            Names of the diag devices.
+        t : float
+            Timestamp, default is now.
+
+        Returns
+        -------
+        r : Residuals
+        """
+        pos, m1, m2 = model
+        s, d1, d2 = (np.asarray(a, dtype=float) for a in diag)
+        r1 = d1 - interp_model(pos, m1, s)
+        r2 = d2 - interp_model(pos, m2, s)
+        r = Residuals(list(names) if names is not None else [None] * len(s),
+                      s, r1, r2, _rms(r1), _rms(r2))
+        with self._lock:
+            self._latest[category] = r
+            h = self._history.setdefault(category, deque(maxlen=self._maxlen))
+            h.append((time.time() if t is None else t, r.rms1, r.rms2))
+        return r
+
+    def latest(self, category):
+        """Return the last Residuals of *category*, or None.
+        """
+        with self._lock:
+            return self._latest.get(category)
+
+    def history(self, category):
+        """Return a tuple of arrays of (t, rms1, rms2) of *category*.
+        """
+        with self._lock:
+            h = list(self._history.get(category, ()))
+        if not h:
+            return np.empty(0), np.empty(0), np.empty(0)
+        return tuple(np.array(a) for a in zip(*h))
+
+    def clear(self):
+        with self._lock:
+            self._latest.clear()
+            self._history.clear()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Response matrices of the beam at the diag devices to the element settings.
+
+The perturbed models are evaluated in parallel by a ModelPool, the matrices
+are cached on disk, one file per lattice and settings, named by the hashes of
+them. For new settings, the matrices of the closest cached settings are
+updated, only the columns of the elements affected by the changed settings
+are computed again.
+
+>>> rm = ResponseMatrix(engine.session, [("FS_F1S1:DCH_D1012", "ANG")],
+...                     ["FS_F1S1:BPM_D1056"], keys=('xcen', 'ycen'))
+>>> r = rm.compute()
+>>> r.matrices['xcen'] # (number of diags, number of settings), mm per unit
+"""
+import hashlib
+import json
+import pathlib
+from collections import namedtuple
+
+import numpy as np
+
+from .model import FLAME_PROP_MAP
+from .model import snapshot_settings
+from .scan import ModelPool
+from .scan import SOURCE_ENAME
+from .scan import SOURCE_PARAMS
+from .scan import make_knob
+
+# BeamState attributes at the diag devices, orbit and envelope
+RESPONSE_KEYS = ('xcen', 'ycen', 'xrms', 'yrms')
+
+# FLAME properties whose responses of the orbit are independent of the
+# incoming beam, i.e. dipole kicks
+KICK_PROPS = ('theta_x', 'theta_y')
+
+# default directory of the cached matrices
+DEFAULT_CACHE_DIR = pathlib.Path("~/.cache/online_model/response").expanduser()
+
+# max number of cached files of each lattice key, the least recently saved
+# ones are removed
+MAX_CACHED_FILES = 20
+
+# settings (list of (element name, field name)), diag element names, dict of
+# the matrices and the beam at the diags of each key, indices of the computed
+# columns, and the key of the settings
+Response = namedtuple('Response',
+                      ('params', 'diags', 'matrices', 'base', 'computed', 'settings_key'))
+
+
+def _hash(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=float).encode()).hexdigest()[:16]
+
+
+class ResponseMatrix(object):
+    """Response matrices of *keys* at the diag devices to the settings of
+    the model *session* (ModelSession), by forward finite differences.
+
+    Parameters
+    ----------
+    session : ModelSession
+        The model, must be run at least once.
+    params : list
+        List of (element name, field name) of the settings.
+    diags : list
+        Names of the diag elements.
+    keys : tuple
+        BeamState attributes of RESPONSE_KEYS.
+    cachedir : str
+        Directory of the cached matrices, None to disable the cache.
+    max_workers : int
+        Number of worker processes, default is the number of CPUs.
+    rel_step : float
+        Relative step of the finite differences.
+    abs_step : float
+        Minimum step of the finite differences.
+    """
+    def __init__(self, session, params, diags, keys=RESPONSE_KEYS,
+                 cachedir=DEFAULT_CACHE_DIR, max_workers=None,
+                 rel_step=1e-4, abs_step=1e-6):
+        self._session = session
+        self.params = [tuple(p) for p in params]
+        self.diags = list(diags)
+        self.keys = tuple(keys)
+        self._cachedir = None if cachedir is None else pathlib.Path(cachedir)
+        self._max_workers = max_workers
+        self._rel_step = rel_step
+        self._abs_step = abs_step
+        self.knobs = [make_knob(session, ename, fname) for ename, fname in self.params]
+        # observables at the exit of each diag device
+        self._diag_indices = [(session.find(ename) or [None])[-1] for ename in self.diags]
+        self.obs = [(i, k) for i in self._diag_indices if i is not None for k in self.keys]
+
+    def lattice_key(self):
+        """Hash of the lattice, the settings to perturb, the diags and the keys.
+        """
+        return _hash([self._session.index.names, self.params, self.diags,
+                      self.keys, self._rel_step, self._abs_step])
+
+    def settings_key(self, settings=None):
+        """Hash of the model settings and the beam source.
+        """
+        if settings is None:
+            settings = self._settings()
+        return _hash([sorted(settings.items()), self._session.source_key])
+
+    def compute(self):
+        """Return the Response of the current model settings, from the cache
+        if possible.
+        """
+        settings = self._settings()
+        skey = self.settings_key(settings)
+        cached = self._load_closest(settings)
+        if cached is not None and cached[0] == skey:
+            _, matrices, base, _, _ = cached
+            return Response(self.params, self.diags, matrices, base, [], skey)
+
+        x0 = np.array([SOURCE_PARAMS[f] if e == SOURCE_ENAME else settings[f"{e}:{f}"]
+                       for e, f in self.params], dtype=float)
+        if cached is None:
+            cols = list(range(len(self.knobs)))
+        else:
+            cols = self._stale_columns(cached[3], cached[4], settings)
+        h = np.maximum(np.abs(x0) * self._rel_step, self._abs_step)
+        points = np.tile(x0, (len(cols) + 1, 1))
+        for ip, j in enumerate(cols, 1):
+            points[ip, j] += h[j]
+        with ModelPool(self._session, self._max_workers) as pool:
+            data = pool.evaluate(self.knobs, points, self.obs)
+        f = self._unpack(data) # key: (points, diags)
+
+        n = (len(self.diags), len(self.knobs))
+        matrices = {k: np.full(n, np.nan) for k in self.keys} if cached is None \
+                   else cached[1]
+        base = {k: f[k][0] for k in self.keys}
+        for k in self.keys:
+            if cols:
+                matrices[k][:, cols] = ((f[k][1:] - f[k][0]) / h[cols, None]).T
+        self._save(skey, settings, matrices, base)
+        return Response(self.params, self.diags, matrices, base, cols, skey)
+
+    def _settings(self):
+        # flat model settings, {"element:field": value}.
+        return {f"{e}:{f}": v for (e, f), v in
+                snapshot_settings(self._session.lattice.settings).items()}
+
+    def _unpack(self, data):
+        # columns of data (obs) into {key: (points, diags)}, NaN for the
+        # diags which cannot be located in the model.
+        r = {k: np.full((data.shape[0], len(self.diags)), np.nan) for k in self.keys}
+        ic = 0
+        for idiag, i in enumerate(self._diag_indices):
+            if i is None:
+                continue
+            for k in self.keys:
+                r[k][:, idiag] = data[:, ic]
+                ic += 1
+        return r
+
+    def _stale_columns(self, settings0, source_key0, settings):
+        # indices of the columns to compute again for the settings changed
+        # from *settings0*: the ones of the settings upstream of the changes,
+        # and for the changes upstream, the ones depending on the incoming beam.
+        # Only the fields of FLAME_PROP_MAP (quads, solenoids, correctors) keep
+        # the energy and rigidity downstream, any other change upstream of the
+        # diags (cavities, strippers, bends, ...) makes all the columns stale.
+        allcols = list(range(len(self.knobs)))
+        if source_key0 != self._session.source_key:
+            return allcols
+        last = max([i for i in self._diag_indices if i is not None], default=-1)
+        changed = set()
+        for k, v in settings.items():
+            if settings0.get(k) == v:
+                continue
+            ename, fname = k.rsplit(':', 1)
+            indices = [i for i in self._session.find(ename) if i <= last]
+            if not indices:
+                continue
+            family = getattr(self._session.index.get(ename), 'family', None)
+            if (family, fname) not in FLAME_PROP_MAP:
+                return allcols
+            changed.update(indices)
+        beam_dependent = any(k in ('xrms', 'yrms') for k in self.keys)
+        cols = []
+        for j, knob in enumerate(self.knobs):
+            i0 = min(knob.indices)
+            for i in changed:
+                if i >= i0 or beam_dependent or knob.prop not in KICK_PROPS:
+                    cols.append(j)
+                    break
+        return cols
+
+    def _path(self, skey):
+        return self._cachedir.joinpath(f"{self.lattice_key()}_{skey}.npz")
+
+    def _save(self, skey, settings, matrices, base):
+        if self._cachedir is None:
+            return
+        self._cachedir.mkdir(parents=True, exist_ok=True)
+        meta = {'settings': settings, 'source_key': self._session.source_key}
+        data = {f'matrix_{k}': v for k, v in matrices.items()}
+        data.update({f'base_{k}': v for k, v in base.items()})
+        np.savez(self._path(skey), meta=json.dumps(meta, default=float), **data)
+        self._prune()
+
+    def _prune(self):
+        # keep the MAX_CACHED_FILES most recently saved files of the lattice key.
+        paths = []
+        for p in self._cachedir.glob(f"{self.lattice_key()}_*.npz"):
+            try:
+                paths.append((p.stat().st_mtime, p))
+            except OSError:
+                continue
+        paths.sort(reverse=True)
+        for _, p in paths[MAX_CACHED_FILES:]:
+            try:
+                p.unlink()
+            except OSError as e:
+                print(f"Cannot remove cached response matrix {p}: {e}")
+
+    def _load_closest(self, settings):
+        # return (settings key, matrices, base, settings, source key) of the
+        # cached file of the fewest changed settings, or None.
+        if self._cachedir is None:
+            return None
+        best, nbest = None, None
+        for p in self._cachedir.glob(f"{self.lattice_key()}_*.npz"):
+            try:
+                with np.load(p) as z:
+                    meta = json.loads(str(z['meta']))
+                    s0 = meta['settings']
+                    n = sum(s0.get(k) != v for k, v in settings.items())
+                    if meta['source_key'] != self._session.source_key:
+                        n += len(settings)
+                    if nbest is not None and n >= nbest:
+                        continue
+                    matrices = {k: z[f'matrix_{k}'] for k in self.keys}
+                    base = {k: z[f'base_{k}'] for k in self.keys}
+            except (OSError, KeyError, ValueError) as e:
+                print(f"Skip invalid cached response matrix {p}: {e}")
+                continue
+            best = (p.stem.rsplit('_', 1)[-1], matrices, base, s0, meta['source_key'])
+            nbest = n
+        return best
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Parameter scan with the online model in a process pool.
+
+Each worker process keeps its own FLAME machine built from the lattice file
+exported from the current model, settings are only applied to the model,
+no PV is written. The parameters are physics fields of the elements, or the
+beam source parameters of SOURCE_PARAMS (element name of SOURCE_ENAME).
+
+>>> scan = ParameterScan(engine.session, "FS_F1S1:PM_D1052")
+>>> r = scan.run([("FS_F1S1:Q_D1013", "B2", np.linspace(5, 10, 200))])
+>>> r['x_rms'].shape
+(200,)
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .engine import TWISS_KEYS_X
+from .engine import TWISS_KEYS_Y
+from .engine import get_twiss_params
+from .model import FLAME_PROP_MAP
+
+# keys of the scan results at the target element
+SCAN_KEYS = [k for k in TWISS_KEYS_X + TWISS_KEYS_Y if k != 'total_intensity']
+
+# one scanned parameter: FLAME element indices and property name
+Knob = namedtuple('Knob', ('ename', 'fname', 'indices', 'prop'))
+
+# element name of the beam source parameters
+SOURCE_ENAME = "SOURCE"
+
+# beam source parameters and the default values: offsets of the centroid
+# (x [mm], x' [rad], y [mm], y' [rad]) and scales of the beam size (x, y),
+# applied to all the charge states
+SOURCE_PARAMS = {'x0': 0.0, 'xp0': 0.0, 'y0': 0.0, 'yp0': 0.0,
+                 'xscale': 1.0, 'yscale': 1.0}
+
+# FLAME model of each worker process, and the initial source configuration
+_fm = None
+_src0 = None
+
+
+def make_knob(session, ename, fname):
+    """Return a Knob for *fname* (physics field) of element *ename* of the
+    model *session* (ModelSession), raise ValueError if cannot be scanned.
+    """
+    if ename == SOURCE_ENAME:
+        if fname not in SOURCE_PARAMS:
+            raise ValueError(f"Invalid beam source parameter '{fname}', "
+                             f"supported: {list(SOURCE_PARAMS)}.")
+        return Knob(ename, fname, (0, ), fname)
+    elem = session.index.get(ename)
+    prop = FLAME_PROP_MAP.get((getattr(elem, 'family', None), fname))
+    if prop is None:
+        raise ValueError(f"Cannot scan '{fname}' of '{ename}', "
+                         f"supported (family, field): {list(FLAME_PROP_MAP)}.")
+    indices = session.find(ename)
+    if not indices:
+        raise ValueError(f"Cannot locate '{ename}' in model.")
+    return Knob(ename, fname, tuple(indices), prop)
+
+
+def source_conf(conf0, values):
+    """Return the properties of the beam source element updated from its
+    configuration *conf0* with *values*, ``{name: value}`` of SOURCE_PARAMS.
+    """
+    vv = conf0.get('vector_variable', 'moment0')
+    mv = conf0.get('matrix_variable', 'initial')
+    offset = np.zeros(7)
+    for i, k in enumerate(('x0', 'xp0', 'y0', 'yp0')):
+        offset[i] = values.get(k, 0.0)
+    scale = np.ones(7)
+    scale[0:2] = values.get('xscale', 1.0)
+    scale[2:4] = values.get('yscale', 1.0)
+    conf = {}
+    for k, v in conf0.items():
+        if k.startswith(vv) and k[len(vv):].isdigit():
+            conf[k] = (np.asarray(v, dtype=float) + offset).tolist()
+        elif k.startswith(mv) and k[len(mv):].isdigit():
+            s = np.asarray(v, dtype=float).reshape(7, 7) * np.outer(scale, scale)
+            conf[k] = s.ravel().tolist()
+    return conf
+
+
+def _init_worker(latfile):
+    global _fm, _src0
+    from flame_utils import ModelFlame
+    _fm = ModelFlame(latfile)
+    _src0 = dict(_fm.machine.conf(0))
+
+
+def _apply_knobs(knobs, values):
+    # apply *values* of *knobs* to the model of the worker process.
+    m = _fm.machine
+    src = {}
+    for knob, v in zip(knobs, values):
+        if knob.ename == SOURCE_ENAME:
+            src[knob.prop] = float(v)
+            continue
+        for i in knob.indices:
+            m.reconfigure(i, {knob.prop: float(v)})
+    if src:
+        m.reconfigure(0, source_conf(_src0, src))
+
+
+def _eval_points(knobs, points, target):
+    # evaluate the model at each of *points* (list of values of *knobs*),
+    # return an array of the values of SCAN_KEYS at *target*.
+    data = np.full((len(points), len(SCAN_KEYS)), np.nan)
+    for ip, values in enumerate(points):
+        _apply_knobs(knobs, values)
+        r, _ = _fm.run(monitor=[target])
+        if r:
+            params_x, params_y = get_twiss_params(r[-1][-1])
+            params_x.update(params_y)
+            data[ip] = [params_x[k] for k in SCAN_KEYS]
+    return data
+
+
+def _eval_observables(knobs, points, obs):
+    # evaluate the model at each of *points* (list of values of *knobs*),
+    # return an array of the values of *obs*, list of (FLAME index,
+    # BeamState attribute).
+    indices = sorted({i for i, _ in obs})
+    data = np.full((len(points), len(obs)), np.nan)
+    for ip, values in enumerate(points):
+        _apply_knobs(knobs, values)
+        r, _ = _fm.run(monitor=indices)
+        states = dict(r)
+        data[ip] = [getattr(states[i], a) if i in states else np.nan for i, a in obs]
+    return data
+
+
+class ModelPool(object):
+    """Worker processes, each keeps a FLAME model built from the current model
+    of *session* (ModelSession), alive in the context.
+
+    >>> with ModelPool(session) as pool:
+    ...     data = pool.evaluate(knobs, points, [(i, 'xrms'), (i, 'yrms')])
+    """
+    def __init__(self, session, max_workers=None):
+        self._session = session
+        self.max_workers = max_workers or os.cpu_count()
+        self._ex = None
+        self._tmpdir = None
+
+    def __enter__(self):
+        self._tmpdir = tempfile.mkdtemp(prefix="online_model_pool_")
+        try:
+            latfile = os.path.join(self._tmpdir, "model.lat")
+            self._session.export_latfile(latfile)
+            # spawn, the parent process usually has CA and Qt threads.
+            self._ex = ProcessPoolExecutor(self.max_workers,
+                                           mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=_init_worker,
+                                           initargs=(latfile, ))
+        except Exception:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self._ex.shutdown()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def map(self, func, *iterables):
+        """Map *func* over *iterables* in the worker processes.
+        """
+        return self._ex.map(func, *iterables)
+
+    def evaluate(self, knobs, points, obs):
+        """Return an array of the values of *obs*, list of (FLAME index,
+        BeamState attribute), for each of *points* (values of *knobs*), the
+        points are split evenly among the workers.
+        """
+        points = np.atleast_2d(points)
+        chunks = np.array_split(points, min(len(points), self.max_workers))
+        return np.concatenate(list(self.map(_eval_observables, [knobs] * len(chunks),
+                                            chunks, [obs] * len(chunks))))
+
+
+class ParameterScan(object):
+    """Scan one (1-D) or two (2-D) parameters of the model.
+
+    Parameters
+    ----------
+    session : ModelSession
+        The model to scan, must be run at least once.
+    target_ename : str
+        Name of the element where the results are taken.
+    max_workers : int
+        Number of worker processes, default is the number of CPUs.
+    chunksize : int
+        Number of points evaluated in one task.
+    """
+    def __init__(self, session, target_ename, max_workers=None, chunksize=8):
+        self._session = session
+        self._target = session.find(target_ename)
+        if not self._target:
+            raise ValueError(f"Cannot locate '{target_ename}' in model.")
+        self._max_workers = max_workers
+        self._chunksize = chunksize
+
+    def run(self, params):
+        """Run the scan over the grid of *params*.
+
+        Parameters
+        ----------
+        params : list
+            List of (element name, field name, values) for each of the
+            scanned parameters, one or two.
+
+        Returns
+        -------
+        r : dict
+            Keys of 'grid' (list of the meshgrid of the scanned values) and
+            the ones of SCAN_KEYS, each value is an array of the grid shape.
+        """
+        if len(params) not in (1, 2):
+            raise ValueError("Only 1-D or 2-D scan is supported.")
+        knobs = [make_knob(self._session, ename, fname) for ename, fname, _ in params]
+        grid = np.meshgrid(*[np.asarray(v, dtype=float) for _, _, v in params],
+                           indexing='ij')
+        points = np.stack([g.ravel() for g in grid], axis=-1)
+        n = self._chunksize
+        chunks = [points[i:i + n] for i in range(0, len(points), n)]
+
+        with ModelPool(self._session, self._max_workers) as pool:
+            data = np.concatenate(list(pool.map(_eval_points,
+                                                [knobs] * len(chunks), chunks,
+                                                [self._target[0]] * len(chunks))))
+
+        r = {'grid': grid}
+        for i, k in enumerate(SCAN_KEYS):
+            r[k] = data[:, i].reshape(grid[0].shape)
+        return r
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Linear surrogate of the model around the operating point of a full run.
+
+The transfer matrices of all the elements of a full run are chained into the
+cumulative ones from the source, a setting change of a few elements then
+updates the centroid and the envelope of all the elements by matrix products,
+with the new transfer matrices of the changed elements only. The change of
+the transfer matrices of the downstream elements with the incoming beam is
+neglected, which is exact for linear elements, a full run is required if the
+settings are changed by more than the tolerance.
+
+>>> sur = LinearSurrogate(results) # results of fm.run(monitor='all')
+>>> beam, state = sur.evaluate({i: transmat}, target=j)
+>>> beam['xrms'] # mm, of all the elements
+>>> get_twiss_params(state)
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# max change of the settings, relative to the setting of the full run, or
+# absolute for the ones usually around zero (kicks [rad])
+REL_TOLERANCE = 0.05
+ABS_TOLERANCE = {'theta_x': 1e-3, 'theta_y': 1e-3}
+
+# max relative error of the beam sizes, and max absolute error of the
+# centroids [mm] of the full run reproduced by the chained transfer matrices,
+# the surrogate is not used if exceeded
+MAX_BUILD_ERROR = 1e-3
+MAX_BUILD_CENTROID_ERROR = 1e-3
+
+# beam state at one element, the attributes read by get_twiss_params, units
+# as BeamState
+LinearState = namedtuple('LinearState', (
+    'xcen', 'xpcen', 'xrms', 'xprms', 'xemittance', 'xnemittance', 'xtwiss_alpha',
+    'xtwiss_beta', 'ycen', 'ypcen', 'yrms', 'yprms', 'yemittance', 'ynemittance',
+    'ytwiss_alpha', 'ytwiss_beta'))
+
+
+def transfer_matrix(state):
+    """Return the 7x7 transfer matrix of the last element of BeamState
+    *state*, of the reference charge state.
+    """
+    m = np.asarray(state.transfer_matrix, dtype=float)
+    return m[:, :, 0] if m.ndim == 3 else m
+
+
+def within_tolerance(prop, v0, v):
+    """Test if the change of FLAME property *prop* from *v0* to *v* could be
+    evaluated by the linear surrogate.
+    """
+    return abs(v - v0) <= max(REL_TOLERANCE * abs(v0), ABS_TOLERANCE.get(prop, 0.0))
+
+
+class LinearSurrogate(object):
+    """Linear surrogate built from the *results* of a full run, list of
+    (index, BeamState) of all the elements from the source.
+    """
+    def __init__(self, results):
+        n = len(results)
+        self.indices = [i for i, _ in results]
+        self._row = {i: r for r, i in enumerate(self.indices)}
+        self.pos = np.array([s.pos for _, s in results])
+        s0 = results[0][1]
+        self._m0 = np.asarray(s0.moment0_env, dtype=float)
+        self._s0 = np.asarray(s0.moment1_env, dtype=float)
+        # cumulative transfer matrices from the source
+        C = np.empty((n, 7, 7))
+        C[0] = np.eye(7)
+        for r in range(1, n):
+            C[r] = transfer_matrix(results[r][1]) @ C[r - 1]
+        self._C = C
+        # beam of the full run
+        m0 = np.array([s.moment0_env for _, s in results])
+        rms = np.array([s.moment0_rms for _, s in results])
+        self._beam = {'xcen': m0[:, 0], 'ycen': m0[:, 2],
+                      'xrms': rms[:, 0], 'yrms': rms[:, 2]}
+        # ratio of normalized to geometric emittances, unchanged
+        self._nratio = [(s.xnemittance / s.xemittance if s.xemittance else 0.0,
+                         s.ynemittance / s.yemittance if s.yemittance else 0.0)
+                        for _, s in results]
+        # how well the full run is reproduced
+        beam = self._propagate(C)
+        ref = np.concatenate((self._beam['xrms'], self._beam['yrms']))
+        err = np.concatenate((beam['xrms'], beam['yrms'])) - ref
+        self.error = float(np.max(np.abs(err) / np.maximum(np.abs(ref), 1e-12))) \
+                     if n else 0.0
+        # the kicks (column 6 of the transfer matrices) are checked by the orbit
+        err = np.concatenate((beam['xcen'] - self._beam['xcen'],
+                              beam['ycen'] - self._beam['ycen']))
+        self.centroid_error = float(np.max(np.abs(err))) if n else 0.0
+        self.valid = self.error <= MAX_BUILD_ERROR and \
+                     self.centroid_error <= MAX_BUILD_CENTROID_ERROR
+
+    def _propagate(self, C):
+        # beam of the elements with the cumulative matrices *C* of them.
+        A = C[:, [0, 2], :]
+        m0 = A @ self._m0
+        var = np.einsum('nij,jk,nik->ni', A, self._s0, A)
+        rms = np.sqrt(np.maximum(var, 0.0))
+        return {'xcen': m0[:, 0], 'ycen': m0[:, 1], 'xrms': rms[:, 0], 'yrms': rms[:, 1]}
+
+    def evaluate(self, transmats, target=None):
+        """Evaluate the beam with the new transfer matrices of the changed
+        elements.
+
+        Parameters
+        ----------
+        transmats : dict
+            ``{index: 7x7 transfer matrix}`` of the changed elements.
+        target : int
+            Index of the element to get the beam state.
+
+        Returns
+        -------
+        r : tuple
+            Tuple of the dict of the arrays of 'xcen', 'ycen', 'xrms', 'yrms'
+            [mm] of all the elements, and the LinearState at *target*, or None.
+        """
+        C, n = self._C, len(self.indices)
+        rows = sorted(self._row[i] for i in transmats)
+        r0 = rows[0] if rows else n
+        Cn = np.empty((n - r0, 7, 7))
+        G = np.eye(7)
+        for a, r in enumerate(rows):
+            # C'_i = C_i G_k ... G_1, G_k = C_k^-1 M'_k C_{k-1}
+            M = transmats[self.indices[r]]
+            G = np.linalg.solve(C[r], M @ C[r - 1]) @ G
+            r1 = rows[a + 1] if a + 1 < len(rows) else n
+            Cn[r - r0:r1 - r0] = C[r:r1] @ G
+        beam = self._propagate(Cn)
+        for k, v in beam.items():
+            beam[k] = np.concatenate((self._beam[k][:r0], v))
+
+        state = None
+        if target is not None:
+            rt = self._row[target]
+            Ct = Cn[rt - r0] if rt >= r0 else C[rt]
+            state = self._state(Ct @ self._m0, Ct @ self._s0 @ Ct.T, self._nratio[rt])
+        return beam, state
+
+    def _state(self, m0, s, nratio):
+        # LinearState of centroid *m0* and sigma matrix *s* [mm, rad].
+        vals = []
+        for i, nr in ((0, nratio[0]), (2, nratio[1])):
+            b = s[i:i + 2, i:i + 2]
+            emit = np.sqrt(max(np.linalg.det(b), 0.0)) # mm-rad
+            beta = b[0, 0] / emit * 1e-3 if emit else np.nan # m
+            alpha = -b[0, 1] / emit if emit else np.nan
+            vals.extend((m0[i], m0[i + 1] * 1e3, np.sqrt(b[0, 0]), np.sqrt(b[1, 1]) * 1e3,
+                         emit * 1e3, emit * 1e3 * nr, alpha, beta))
+        return LinearState(*vals)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Timing instrumentation of the app.
+
+Stage timer of the update pipeline, the durations of each stage are kept in a
+rolling window, summarized as percentiles:
+
+>>> timer = StageTimer()
+>>> with timer.stage('flame_run'):
+...     fm.run(monitor='all')
+>>> timer.stats()['flame_run']['p50']
+>>> timer.dump("timing.json")
+
+Startup report, enabled by setting the environment variable
+``ONLINE_MODEL_STARTUP_REPORT``, e.g.
+
+>>> ONLINE_MODEL_STARTUP_REPORT=1 online_model
+
+the wall time and the newly imported packages of each startup stage are
+printed to stderr once the window is shown; for the import time of every
+module, run with ``python -X importtime``.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# environment variable to enable the startup report
+STARTUP_REPORT_ENV = "ONLINE_MODEL_STARTUP_REPORT"
+
+# stages of the update pipeline, in order
+PIPELINE_STAGES = ('sync_settings', 'model_build', 'flame_run', 'collect_data',
+                   'twiss', 'diag_read', 'residual', 'plot_redraw', 'table_refresh')
+
+# percentiles of the stage durations
+PERCENTILES = (50, 90, 99)
+
+
+def _packages():
+    return {k.split('.', 1)[0] for k in sys.modules}
+
+
+class StartupReport(object):
+    """Record the startup stages, nothing is recorded if not *enabled*.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = [] # list of (name, seconds, list of new packages)
+
+    @classmethod
+    def from_env(cls):
+        return cls(bool(os.environ.get(STARTUP_REPORT_ENV)))
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        pkgs = _packages()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            self.stages.append((name, dt, sorted(_packages() - pkgs)))
+
+    def print_report(self, file=None):
+        if not self.enabled:
+            return
+        file = sys.stderr if file is None else file
+        total = sum(dt for _, dt, _ in self.stages)
+        print(f"Startup time: {total:.3f} s", file=file)
+        for name, dt, pkgs in self.stages:
+            print(f"  {name:<24s}{dt:8.3f} s", file=file)
+            if pkgs:
+                print(f"    new packages: {', '.join(pkgs)}", file=file)
+
+
+class StageTimer(object):
+    """Durations of named stages, the last *window* ones of each stage are
+    kept, thread-safe.
+    """
+    def __init__(self, window=500):
+        self._window = window
+        self._lock = threading.Lock()
+        self._samples = {} # stage: deque of seconds
+        self._counts = {} # stage: total count
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, name, dt):
+        """Add a duration *dt* (second) of stage *name*.
+        """
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=self._window)
+                self._counts[name] = 0
+            self._samples[name].append(dt)
+            self._counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+    def stats(self):
+        """Return a dict of ``{stage: {'count', 'last', 'mean', 'p50', 'p90',
+        'p99'}}``, durations in second, stages of PIPELINE_STAGES first.
+        """
+        with self._lock:
+            samples = {k: np.array(v) for k, v in self._samples.items()}
+            counts = dict(self._counts)
+        names = [i for i in PIPELINE_STAGES if i in samples] + \
+                sorted(set(samples) - set(PIPELINE_STAGES))
+        r = {}
+        for name in names:
+            a = samples[name]
+            d = {'count': counts[name], 'last': a[-1], 'mean': a.mean()}
+            d.update(zip((f'p{i}' for i in PERCENTILES), np.percentile(a, PERCENTILES)))
+            r[name] = d
+        return r
+
+    def summary(self):
+        """Return a one-line string of the median durations in ms.
+        """
+        return ', '.join(f"{k}: {v['p50'] * 1e3:.1f}" for k, v in self.stats().items())
+
+    def dump(self, filepath):
+        """Write the stats and the samples (second) into *filepath* (JSON).
+        """
+        with self._lock:
+            samples = {k: list(v) for k, v in self._samples.items()}
+        data = {'window': self._window, 'stats': self.stats(), 'samples': samples}
+        with open(filepath, 'w') as fp:
+            json.dump(data, fp, indent=2, default=float)
@@ -35,30 +35,23 @@ NAME_MAP = {
     'yp_rms': (f"{SIGMA}(y')", 'mrad'),
 }
 
-# key strings for Twiss X,Y parameters
-TWISS_KEYS_X = [
-    i.format(u='x') for i in ('{u}_cen', '{u}p_cen', '{u}_rms', '{u}p_rms',
-                              'emit_{u}', 'emitn_{u}', 'alpha_{u}', 'beta_{u}',
-                              'gamma_{u}', 'total_intensity')
-]
-TWISS_KEYS_Y = [
-    i.format(u='y') for i in ('{u}_cen', '{u}p_cen', '{u}_rms', '{u}p_rms',
-                              'emit_{u}', 'emitn_{u}', 'alpha_{u}', 'beta_{u}',
-                              'gamma_{u}', 'total_intensity')
-]
-
-
 
 class ResultsModel(QStandardItemModel):
-    """Data model for Twiss parameters.
+    """Data model for Twiss parameters, the rows are created once, then the
+    values are updated in place, only the changed items are touched.
 
-    data : list of values (list), [parameter, value, value1]
+    data : list of values (list), [parameter, value, value1], value1 is '-'
+    to use the reference value, see :meth:`set_reference`.
     """
-    def __init__(self, parent, data, **kws):
+    def __init__(self, parent, data=None, **kws):
         super(self.__class__, self).__init__(parent)
         self._v = parent
-        self._data = data
+        self._data = [] if data is None else data
         self._fmt = "{0:>.3f}"
+        self._rows = {} # parameter: (item of v0, item of v1, item of diff)
+        self._v0 = {} # parameter: model value
+        self._ref = {} # parameter: reference (measured) value
+        self._updating = False
 
         #
         self.header = self.h_param, self.h_unit, self.h_value, \
@@ -66,30 +59,88 @@ class ResultsModel(QStandardItemModel):
                     = "Parameter", "Unit", "Model (v0)", "Measured (v1)", f"{DELTA}(v0, v1)"
         self.ids = self.i_param, self.i_unit, self.i_value, self._i_value1, self.i_diff \
                  = range(len(self.header))
-
-    def set_data(self):
+        self.itemChanged.connect(self.on_item_changed)
+
+    def set_data(self, data=None):
+        """Update the model with *data*, new rows are appended if needed.
+        """
+        if data is not None:
+            self._data = data
+        new_rows = False
         for name, v0, v1 in self._data:
-            name_tuple = NAME_MAP.get(name, None)
-            if name_tuple is None:
+            if name not in NAME_MAP:
                 continue
-            name, unit = name_tuple
-            it_param = QStandardItem(name)
-            it_unit = QStandardItem(unit)
-            it_v0 = QStandardItem(self._fmt.format(v0))
-            if v1 == '-':
-                it_v1 = QStandardItem('-')
-                it_dv = QStandardItem('-')
-            else:
-                it_v1 = QStandardItem(self._fmt.format(v1))
-                it_dv = QStandardItem(self._fmt.format(v0 - v1))
-            row = [it_param, it_unit, it_v0, it_v1, it_dv]
-            for o in (it_param, it_unit, it_v0):
-                o.setEditable(False)
-            self.appendRow(row)
+            if name not in self._rows:
+                self._append_row(name)
+                new_rows = True
+            self._v0[name] = v0
+            if v1 != '-':
+                self._ref[name] = v1
+            self._update_row(name)
+        if new_rows and self._v.model() is self:
+            self._v.model().sort(self.i_param)
+            self.fit_view()
+
+    def set_reference(self, ref):
+        """Set the reference (measured) values, *ref* is a dict of
+        {parameter: value}, the stored references are replaced.
+        """
+        self._ref = dict(ref)
+        for name in self._rows:
+            self._update_row(name)
+
+    def get_reference(self):
+        """Return a dict of the reference values.
+        """
+        return dict(self._ref)
+
+    def current_values(self):
+        """Return a dict of the current model values.
+        """
+        return dict(self._v0)
+
+    def _append_row(self, name):
+        label, unit = NAME_MAP[name]
+        it_param = QStandardItem(label)
+        it_unit = QStandardItem(unit)
+        it_v0, it_v1, it_dv = QStandardItem('-'), QStandardItem('-'), QStandardItem('-')
+        for o in (it_param, it_unit, it_v0, it_dv):
+            o.setEditable(False)
+        it_v1.setData(name, Qt.UserRole)
+        self._rows[name] = (it_v0, it_v1, it_dv)
+        self.appendRow([it_param, it_unit, it_v0, it_v1, it_dv])
+
+    def _update_row(self, name):
+        v0, v1 = self._v0.get(name), self._ref.get(name)
+        texts = ['-' if v0 is None else self._fmt.format(v0),
+                 '-' if v1 is None else self._fmt.format(v1),
+                 '-' if v0 is None or v1 is None else self._fmt.format(v0 - v1)]
+        self._updating = True
+        for it, txt in zip(self._rows[name], texts):
+            if it.text() != txt:
+                it.setText(txt)
+        self._updating = False
+
+    def on_item_changed(self, item):
+        # reference value is edited by user.
+        if self._updating:
+            return
+        name = item.data(Qt.UserRole)
+        if name is None or name not in self._rows:
+            return
+        try:
+            v1 = float(item.text())
+        except ValueError:
+            self._ref.pop(name, None)
+        else:
+            if self._ref.get(name) == v1:
+                return
+            self._ref[name] = v1
+        self._update_row(name)
 
     def set_model(self):
-        self.set_data()
         self._v.setModel(self)
+        self.set_data()
         self.__post_init_ui()
 
     def __post_init_ui(self):
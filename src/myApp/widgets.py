@@ -0,0 +1,816 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Auxiliary widgets of the online model app.
+"""
+import datetime
+import pathlib
+
+import numpy as np
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import pyqtSlot
+from PyQt5.QtWidgets import QCheckBox
+from PyQt5.QtWidgets import QComboBox
+from PyQt5.QtWidgets import QDoubleSpinBox
+from PyQt5.QtWidgets import QFileDialog
+from PyQt5.QtWidgets import QGridLayout
+from PyQt5.QtWidgets import QHBoxLayout
+from PyQt5.QtWidgets import QLabel
+from PyQt5.QtWidgets import QListWidget
+from PyQt5.QtWidgets import QMessageBox
+from PyQt5.QtWidgets import QPushButton
+from PyQt5.QtWidgets import QSlider
+from PyQt5.QtWidgets import QSpinBox
+from PyQt5.QtWidgets import QTableWidget
+from PyQt5.QtWidgets import QTableWidgetItem
+from PyQt5.QtWidgets import QVBoxLayout
+from PyQt5.QtWidgets import QWidget
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.figure import Figure
+
+from phantasy_ui import get_save_filename
+
+from .fitting import FIT_ATTRS
+from .fitting import ModelFit
+from .recorder import RecordingReader
+from .model import FLAME_PROP_MAP
+from .replay import ReplayPlayer
+from .response import RESPONSE_KEYS
+from .response import ResponseMatrix
+from .scan import ParameterScan
+from .scan import SCAN_KEYS
+from .scan import SOURCE_ENAME
+from .scan import SOURCE_PARAMS
+from .timing import PERCENTILES
+from .worker import SimulationWorker
+
+
+class _ParamRow(object):
+    # widgets to define one scanned parameter in the row *row* of *layout*.
+    def __init__(self, layout, row, title, settings):
+        self._settings = settings
+        self.ename_cbb = QComboBox()
+        self.fname_cbb = QComboBox()
+        self.start_dsbox, self.stop_dsbox = QDoubleSpinBox(), QDoubleSpinBox()
+        for o in (self.start_dsbox, self.stop_dsbox):
+            o.setRange(-1e6, 1e6)
+            o.setDecimals(4)
+        self.num_sbox = QSpinBox()
+        self.num_sbox.setRange(2, 10000)
+        self.num_sbox.setValue(20)
+        self.ename_cbb.currentTextChanged.connect(self.on_ename_changed)
+        self.fname_cbb.currentTextChanged.connect(self.on_fname_changed)
+        self.widgets = (self.ename_cbb, self.fname_cbb, self.start_dsbox,
+                        self.stop_dsbox, self.num_sbox)
+        layout.addWidget(QLabel(title), row, 0)
+        for i, o in enumerate(self.widgets, 1):
+            layout.addWidget(o, row, i)
+        self.ename_cbb.addItems(list(settings))
+
+    def setEnabled(self, enabled):
+        for o in self.widgets:
+            o.setEnabled(enabled)
+
+    def set_param(self, ename, fname):
+        self.ename_cbb.setCurrentText(ename)
+        self.fname_cbb.setCurrentText(fname)
+
+    @pyqtSlot('QString')
+    def on_ename_changed(self, ename):
+        self.fname_cbb.clear()
+        self.fname_cbb.addItems(list(self._settings.get(ename, ())))
+
+    @pyqtSlot('QString')
+    def on_fname_changed(self, fname):
+        # default range: +/-10% around the current model setting.
+        v = self._settings.get(self.ename_cbb.currentText(), {}).get(fname)
+        if v is None:
+            return
+        dv = abs(v) * 0.1 or 1.0
+        self.start_dsbox.setValue(v - dv)
+        self.stop_dsbox.setValue(v + dv)
+
+    def param(self):
+        return (self.ename_cbb.currentText(), self.fname_cbb.currentText(),
+                np.linspace(self.start_dsbox.value(), self.stop_dsbox.value(),
+                            self.num_sbox.value()))
+
+
+class ScanWidget(QWidget):
+    """Scan one or two settings (physics fields) of the model in parallel,
+    and plot the results at the target element, no PV is written.
+
+    Parameters
+    ----------
+    engine : OnlineModelEngine
+        Online model with the loaded lattice and run at least once.
+    """
+    def __init__(self, engine, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self.setWindowTitle("Parameter Scan")
+        self._engine = engine
+        self._results = None
+
+        settings = engine.lat.settings
+        grid = QGridLayout()
+        for i, s in enumerate(("", "Element", "Field", "Start", "Stop", "Points"), 0):
+            grid.addWidget(QLabel(s), 0, i)
+        self._p1 = _ParamRow(grid, 1, "Parameter 1", settings)
+        self._p2 = _ParamRow(grid, 2, "Parameter 2", settings)
+        self._p2_chkbox = QCheckBox("2-D")
+        self._p2_chkbox.toggled.connect(self._p2.setEnabled)
+        self._p2.setEnabled(False)
+        grid.addWidget(self._p2_chkbox, 2, 6)
+
+        self.target_cbb = QComboBox()
+        self.target_cbb.addItems(engine.index.names)
+        self.result_cbb = QComboBox()
+        self.result_cbb.addItems(SCAN_KEYS)
+        self.result_cbb.currentTextChanged.connect(self.on_plot_results)
+        self.run_btn = QPushButton("Run")
+        self.run_btn.clicked.connect(self.on_run)
+        self.save_btn = QPushButton("Save")
+        self.save_btn.clicked.connect(self.on_save)
+        grid.addWidget(QLabel("Target"), 3, 0)
+        grid.addWidget(self.target_cbb, 3, 1, 1, 2)
+        grid.addWidget(QLabel("Show"), 3, 3)
+        grid.addWidget(self.result_cbb, 3, 4)
+        grid.addWidget(self.run_btn, 3, 5)
+        grid.addWidget(self.save_btn, 3, 6)
+
+        self._fig = Figure(figsize=(6, 4))
+        self._canvas = FigureCanvasQTAgg(self._fig)
+        layout = QVBoxLayout(self)
+        layout.addLayout(grid)
+        layout.addWidget(self._canvas)
+
+        self._worker = SimulationWorker(self._scan)
+        self._worker.simStarted.connect(lambda _: self.run_btn.setEnabled(False))
+        self._worker.simFinished.connect(lambda _: self.run_btn.setEnabled(True))
+        self._worker.resultsReady.connect(self.on_results_ready)
+
+    def set_params(self, ename, fname, target_ename):
+        """Preset the first parameter and the target element.
+        """
+        self._p1.set_param(ename, fname)
+        self.target_cbb.setCurrentText(target_ename)
+
+    def showEvent(self, e):
+        # the worker is stopped when closed, start it again when reopened.
+        if not self._worker.isRunning():
+            self._worker.start()
+        QWidget.showEvent(self, e)
+
+    def closeEvent(self, e):
+        self._worker.stop()
+        QWidget.closeEvent(self, e)
+
+    def _scan(self, request):
+        # run in the worker thread, the exception is returned if failed.
+        target, params = request
+        try:
+            r = ParameterScan(self._engine.session, target).run(params)
+        except Exception as e:
+            return e
+        return params, r
+
+    @pyqtSlot()
+    def on_run(self):
+        params = [self._p1.param()]
+        if self._p2_chkbox.isChecked():
+            params.append(self._p2.param())
+        if self._engine.session is None or self._engine.session.fm is None:
+            QMessageBox.warning(self, "Parameter Scan",
+                    "Update the model before scanning.", QMessageBox.Ok)
+            return
+        self._worker.submit((self.target_cbb.currentText(), params))
+
+    @pyqtSlot(object)
+    def on_results_ready(self, res):
+        if isinstance(res, Exception):
+            QMessageBox.warning(self, "Parameter Scan", f"Scan failed: {res}",
+                                QMessageBox.Ok)
+            return
+        self._results = res
+        self.on_plot_results(self.result_cbb.currentText())
+
+    @pyqtSlot('QString')
+    def on_plot_results(self, key):
+        if self._results is None:
+            return
+        params, r = self._results
+        self._fig.clear()
+        ax = self._fig.add_subplot(111)
+        if len(params) == 1:
+            ax.plot(r['grid'][0], r[key], 'o-')
+            ax.set_ylabel(key)
+        else:
+            im = ax.pcolormesh(r['grid'][0], r['grid'][1], r[key], shading='auto')
+            self._fig.colorbar(im, ax=ax, label=key)
+            ax.set_ylabel("{}:{}".format(*params[1][:2]))
+        ax.set_xlabel("{}:{}".format(*params[0][:2]))
+        self._canvas.draw_idle()
+
+    @pyqtSlot()
+    def on_save(self):
+        if self._results is None:
+            return
+        filename, ext = get_save_filename(self,
+                                          caption="Save scan results",
+                                          cdir='.',
+                                          type_filter="NumPy Data File (*.npz)")
+        if filename is None:
+            return
+        params, r = self._results
+        data = {k: v for k, v in r.items() if k != 'grid'}
+        for i, (ename, fname, _) in enumerate(params):
+            data[f'param{i + 1}'] = r['grid'][i]
+            data[f'param{i + 1}_name'] = f"{ename}:{fname}"
+        np.savez_compressed(filename, **data)
+
+
+class FitWidget(QWidget):
+    """Fit the beam source parameters and/or the element settings of the
+    model to the readings of the selected diag devices, the fitted values are
+    applied to the model by :attr:`fitApplied`, no PV is written.
+
+    Parameters
+    ----------
+    engine : OnlineModelEngine
+        Online model with the loaded lattice and run at least once.
+    """
+    # model settings {ename: {fname: value}}, beam source properties or None
+    fitApplied = pyqtSignal(dict, object)
+
+    def __init__(self, engine, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self.setWindowTitle("Fit Model")
+        self._engine = engine
+        self._fit = None
+        self._result = None
+
+        grid = QGridLayout()
+        grid.addWidget(QLabel("Fit to"), 0, 0)
+        self._category_chkboxes = {}
+        for i, k in enumerate(FIT_ATTRS, 1):
+            o = QCheckBox(k.capitalize())
+            o.setChecked(True)
+            self._category_chkboxes[k] = o
+            grid.addWidget(o, 0, i)
+        grid.addWidget(QLabel("Beam Source"), 1, 0)
+        self._source_chkboxes = {}
+        for i, k in enumerate(SOURCE_PARAMS, 1):
+            o = QCheckBox(k)
+            self._source_chkboxes[k] = o
+            grid.addWidget(o, 1, i)
+
+        self.ename_cbb = QComboBox()
+        self.fname_cbb = QComboBox()
+        self.ename_cbb.currentTextChanged.connect(self.on_ename_changed)
+        self.ename_cbb.addItems(list(engine.lat.settings))
+        self.add_btn = QPushButton("Add")
+        self.add_btn.clicked.connect(self.on_add_param)
+        self.remove_btn = QPushButton("Remove")
+        self.remove_btn.clicked.connect(self.on_remove_params)
+        grid.addWidget(QLabel("Element"), 2, 0)
+        grid.addWidget(self.ename_cbb, 2, 1, 1, 3)
+        grid.addWidget(self.fname_cbb, 2, 4)
+        grid.addWidget(self.add_btn, 2, 5)
+        grid.addWidget(self.remove_btn, 2, 6)
+        self.params_list = QListWidget()
+        self.params_list.setSelectionMode(QListWidget.ExtendedSelection)
+
+        self.table = QTableWidget(0, 2)
+        self.table.setHorizontalHeaderLabels(["Initial", "Fitted"])
+        self.cost_lbl = QLabel()
+        self.run_btn = QPushButton("Run")
+        self.run_btn.clicked.connect(self.on_run)
+        self.apply_btn = QPushButton("Apply")
+        self.apply_btn.setToolTip("Apply the fitted values to the model.")
+        self.apply_btn.clicked.connect(self.on_apply)
+        self.apply_btn.setEnabled(False)
+        hbox = QHBoxLayout()
+        hbox.addWidget(self.cost_lbl)
+        hbox.addStretch()
+        hbox.addWidget(self.run_btn)
+        hbox.addWidget(self.apply_btn)
+        layout = QVBoxLayout(self)
+        layout.addLayout(grid)
+        layout.addWidget(self.params_list)
+        layout.addWidget(self.table)
+        layout.addLayout(hbox)
+
+        self._worker = SimulationWorker(self._run_fit)
+        self._worker.simStarted.connect(lambda _: self.run_btn.setEnabled(False))
+        self._worker.simFinished.connect(lambda _: self.run_btn.setEnabled(True))
+        self._worker.resultsReady.connect(self.on_results_ready)
+
+    def showEvent(self, e):
+        # the worker is stopped when closed, start it again when reopened.
+        if not self._worker.isRunning():
+            self._worker.start()
+        QWidget.showEvent(self, e)
+
+    def closeEvent(self, e):
+        self._worker.stop()
+        QWidget.closeEvent(self, e)
+
+    def _params(self):
+        params = [(SOURCE_ENAME, k) for k, o in self._source_chkboxes.items()
+                  if o.isChecked()]
+        for i in range(self.params_list.count()):
+            params.append(tuple(self.params_list.item(i).text().rsplit(':', 1)))
+        return params
+
+    def _run_fit(self, fit):
+        # run in the worker thread, the exception is returned if failed.
+        try:
+            return fit.run()
+        except Exception as e:
+            return e
+
+    @pyqtSlot('QString')
+    def on_ename_changed(self, ename):
+        self.fname_cbb.clear()
+        self.fname_cbb.addItems(list(self._engine.lat.settings.get(ename, ())))
+
+    @pyqtSlot()
+    def on_remove_params(self):
+        for o in self.params_list.selectedItems():
+            self.params_list.takeItem(self.params_list.row(o))
+
+    @pyqtSlot()
+    def on_add_param(self):
+        s = f"{self.ename_cbb.currentText()}:{self.fname_cbb.currentText()}"
+        if self.fname_cbb.currentText() and not self.params_list.findItems(s, Qt.MatchExactly):
+            self.params_list.addItem(s)
+
+    @pyqtSlot()
+    def on_run(self):
+        engine = self._engine
+        if engine.session is None or engine.session.fm is None:
+            QMessageBox.warning(self, "Fit Model",
+                    "Update the model before fitting.", QMessageBox.Ok)
+            return
+        measured = {}
+        for k, o in self._category_chkboxes.items():
+            data = engine.diag_data(k) if o.isChecked() else None
+            if data is not None:
+                measured[k] = ([e.name for e in engine.diag_elems[k]], data[1], data[2])
+        try:
+            self._fit = ModelFit(engine.session, measured, self._params())
+        except ValueError as e:
+            QMessageBox.warning(self, "Fit Model", str(e), QMessageBox.Ok)
+            return
+        self._result = None
+        self.apply_btn.setEnabled(False)
+        self.cost_lbl.setText("Fitting...")
+        self._worker.submit(self._fit)
+
+    @pyqtSlot(object)
+    def on_results_ready(self, r):
+        if isinstance(r, Exception):
+            self.cost_lbl.setText("Fit failed.")
+            QMessageBox.warning(self, "Fit Model", f"Fit failed: {r}", QMessageBox.Ok)
+            return
+        self._result = r
+        self.cost_lbl.setText(
+                f"RMS residual (mm): {np.sqrt(2 * r.cost[0] / len(r.measured)):.4g} -> "
+                f"{np.sqrt(2 * r.cost[-1] / len(r.measured)):.4g}, "
+                f"{r.niter} iterations")
+        self.table.setRowCount(len(r.knobs))
+        self.table.setVerticalHeaderLabels([f"{k.ename}:{k.fname}" for k in r.knobs])
+        for i, row in enumerate(zip(r.x0, r.x)):
+            for j, v in enumerate(row):
+                self.table.setItem(i, j, QTableWidgetItem(f"{v:.6g}"))
+        self.table.resizeColumnsToContents()
+        self.apply_btn.setEnabled(True)
+
+    @pyqtSlot()
+    def on_apply(self):
+        if self._result is None:
+            return
+        settings, src = self._fit.split(self._result.x)
+        self.fitApplied.emit(settings, src)
+
+
+class ResponseWidget(QWidget):
+    """Response matrices of the orbit and/or the envelope at the selected diag
+    devices to the settings of the chosen element families, computed in
+    parallel and cached on disk.
+
+    Parameters
+    ----------
+    engine : OnlineModelEngine
+        Online model with the loaded lattice and run at least once.
+    """
+    def __init__(self, engine, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self.setWindowTitle("Response Matrix")
+        self._engine = engine
+        self._rm = None
+        self._results = None
+
+        grid = QGridLayout()
+        grid.addWidget(QLabel("Elements"), 0, 0)
+        self._family_chkboxes = {}
+        families = [f for f, _ in FLAME_PROP_MAP if f in engine.index.families]
+        for i, family in enumerate(families, 1):
+            o = QCheckBox(family)
+            o.setChecked(family in ('HCOR', 'VCOR'))
+            self._family_chkboxes[family] = o
+            grid.addWidget(o, 0, i)
+        grid.addWidget(QLabel("Response of"), 1, 0)
+        self.orbit_chkbox = QCheckBox("Orbit")
+        self.orbit_chkbox.setChecked(True)
+        self.envelope_chkbox = QCheckBox("Envelope")
+        grid.addWidget(self.orbit_chkbox, 1, 1)
+        grid.addWidget(self.envelope_chkbox, 1, 2)
+
+        self.info_lbl = QLabel()
+        self.result_cbb = QComboBox()
+        self.result_cbb.currentTextChanged.connect(self.on_plot_results)
+        self.run_btn = QPushButton("Compute")
+        self.run_btn.clicked.connect(self.on_run)
+        self.save_btn = QPushButton("Save")
+        self.save_btn.clicked.connect(self.on_save)
+        hbox = QHBoxLayout()
+        hbox.addWidget(self.info_lbl)
+        hbox.addStretch()
+        hbox.addWidget(QLabel("Show"))
+        hbox.addWidget(self.result_cbb)
+        hbox.addWidget(self.run_btn)
+        hbox.addWidget(self.save_btn)
+
+        self._fig = Figure(figsize=(6, 4))
+        self._canvas = FigureCanvasQTAgg(self._fig)
+        layout = QVBoxLayout(self)
+        layout.addLayout(grid)
+        layout.addLayout(hbox)
+        layout.addWidget(self._canvas)
+
+        self._worker = SimulationWorker(self._compute)
+        self._worker.simStarted.connect(lambda _: self.run_btn.setEnabled(False))
+        self._worker.simFinished.connect(lambda _: self.run_btn.setEnabled(True))
+        self._worker.resultsReady.connect(self.on_results_ready)
+
+    def showEvent(self, e):
+        # the worker is stopped when closed, start it again when reopened.
+        if not self._worker.isRunning():
+            self._worker.start()
+        QWidget.showEvent(self, e)
+
+    def closeEvent(self, e):
+        self._worker.stop()
+        QWidget.closeEvent(self, e)
+
+    def _compute(self, rm):
+        # run in the worker thread, the exception is returned if failed.
+        try:
+            return rm.compute()
+        except Exception as e:
+            return e
+
+    @pyqtSlot()
+    def on_run(self):
+        engine = self._engine
+        if engine.session is None or engine.session.fm is None:
+            QMessageBox.warning(self, "Response Matrix",
+                    "Update the model before computing.", QMessageBox.Ok)
+            return
+        families = [f for f, o in self._family_chkboxes.items() if o.isChecked()]
+        params = [(e.name, fname) for e in engine.index
+                  if e.family in families and e.name in engine.lat.settings
+                  for fname in engine.lat.settings[e.name]
+                  if (e.family, fname) in FLAME_PROP_MAP]
+        elems = {e.name: e for k in ('trajectory', 'envelope') for e in engine.diag_elems[k]}
+        diags = [e.name for e in sorted(elems.values(), key=lambda e: e.sb)]
+        keys = RESPONSE_KEYS[:2] * self.orbit_chkbox.isChecked() + \
+               RESPONSE_KEYS[2:] * self.envelope_chkbox.isChecked()
+        if not (params and diags and keys):
+            QMessageBox.warning(self, "Response Matrix",
+                    "Select element families, diag devices and responses.", QMessageBox.Ok)
+            return
+        self._rm = ResponseMatrix(engine.session, params, diags, keys)
+        self.info_lbl.setText("Computing...")
+        self._worker.submit(self._rm)
+
+    @pyqtSlot(object)
+    def on_results_ready(self, r):
+        if isinstance(r, Exception):
+            self.info_lbl.setText("Failed.")
+            QMessageBox.warning(self, "Response Matrix",
+                    f"Response matrix failed: {r}", QMessageBox.Ok)
+            return
+        self._results = r
+        n = len(r.params)
+        self.info_lbl.setText(
+                f"{len(r.diags)} diags x {n} settings, {len(r.computed)} of {n} "
+                f"columns computed")
+        key = self.result_cbb.currentText()
+        self.result_cbb.blockSignals(True)
+        self.result_cbb.clear()
+        self.result_cbb.addItems(list(r.matrices))
+        self.result_cbb.blockSignals(False)
+        if key in r.matrices:
+            self.result_cbb.setCurrentText(key)
+        self.on_plot_results(self.result_cbb.currentText())
+
+    @pyqtSlot('QString')
+    def on_plot_results(self, key):
+        if self._results is None or key not in self._results.matrices:
+            return
+        self._fig.clear()
+        ax = self._fig.add_subplot(111)
+        im = ax.imshow(self._results.matrices[key], aspect='auto', interpolation='none')
+        self._fig.colorbar(im, ax=ax, label=f"d{key} (mm per unit)")
+        ax.set_xlabel("Setting")
+        ax.set_ylabel("Diag")
+        self._canvas.draw_idle()
+
+    @pyqtSlot()
+    def on_save(self):
+        if self._results is None:
+            return
+        filename, ext = get_save_filename(self,
+                                          caption="Save response matrices",
+                                          cdir='.',
+                                          type_filter="NumPy Data File (*.npz)")
+        if filename is None:
+            return
+        r = self._results
+        data = {k: v for k, v in r.matrices.items()}
+        data.update({f'base_{k}': v for k, v in r.base.items()})
+        data['params'] = [f"{e}:{f}" for e, f in r.params]
+        data['diags'] = r.diags
+        np.savez_compressed(filename, **data)
+
+
+class TimingWidget(QWidget):
+    """Table of the durations (ms) of the update stages, refreshed every
+    second, could be dumped into a JSON file.
+
+    Parameters
+    ----------
+    timer : StageTimer
+        Timer of the online model, e.g. ``engine.timer``.
+    """
+    def __init__(self, timer, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self.setWindowTitle("Timing")
+        self._timer = timer
+        self._cols = ['count', 'last', 'mean'] + [f'p{i}' for i in PERCENTILES]
+
+        self.table = QTableWidget(0, len(self._cols))
+        self.table.setHorizontalHeaderLabels(
+                ['Count'] + [f'{s} (ms)' for s in self._cols[1:]])
+        self.reset_btn = QPushButton("Reset")
+        self.reset_btn.clicked.connect(self.on_reset)
+        self.dump_btn = QPushButton("Dump")
+        self.dump_btn.clicked.connect(self.on_dump)
+        hbox = QHBoxLayout()
+        hbox.addStretch()
+        hbox.addWidget(self.reset_btn)
+        hbox.addWidget(self.dump_btn)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.table)
+        layout.addLayout(hbox)
+
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.timeout.connect(self.on_refresh)
+        self._refresh_timer.start(1000)
+        self.on_refresh()
+
+    @pyqtSlot()
+    def on_refresh(self):
+        if not self.isVisible():
+            return
+        stats = self._timer.stats()
+        self.table.setRowCount(len(stats))
+        self.table.setVerticalHeaderLabels(list(stats))
+        for i, d in enumerate(stats.values()):
+            for j, k in enumerate(self._cols):
+                s = str(d[k]) if k == 'count' else f"{d[k] * 1e3:.2f}"
+                self.table.setItem(i, j, QTableWidgetItem(s))
+        self.table.resizeColumnsToContents()
+
+    @pyqtSlot()
+    def on_reset(self):
+        self._timer.reset()
+        self.on_refresh()
+
+    @pyqtSlot()
+    def on_dump(self):
+        filename, ext = get_save_filename(self,
+                                          caption="Dump timing data",
+                                          cdir='.',
+                                          type_filter="JSON Files (*.json)")
+        if filename is None:
+            return
+        self._timer.dump(filename)
+
+    def showEvent(self, e):
+        QWidget.showEvent(self, e)
+        self.on_refresh()
+
+
+class ResidualWidget(QWidget):
+    """Residuals (measured - model, mm) of the selected diag devices and the
+    history of the RMS residuals, refreshed every second.
+
+    Parameters
+    ----------
+    residuals : ResidualTracker
+        Residuals of the online model, e.g. ``engine.residuals``.
+    """
+    def __init__(self, residuals, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self.setWindowTitle("Residuals")
+        self._residuals = residuals
+
+        self.category_cbb = QComboBox()
+        self.category_cbb.addItems(('envelope', 'trajectory'))
+        self.category_cbb.currentTextChanged.connect(self.on_refresh)
+        self.rms_lbl = QLabel()
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel("Category"))
+        hbox.addWidget(self.category_cbb)
+        hbox.addStretch()
+        hbox.addWidget(self.rms_lbl)
+
+        self.table = QTableWidget(0, 3)
+        self.table.setHorizontalHeaderLabels(["Position (m)", "X (mm)", "Y (mm)"])
+        self._fig = Figure(figsize=(6, 3))
+        self._canvas = FigureCanvasQTAgg(self._fig)
+        self._ax = self._fig.add_subplot(111)
+        self._lines = [self._ax.plot([], [], label=s)[0] for s in ("X", "Y")]
+        self._ax.set_xlabel("Time (s)")
+        self._ax.set_ylabel("RMS Residual (mm)")
+        self._ax.legend(loc='upper left')
+        layout = QVBoxLayout(self)
+        layout.addLayout(hbox)
+        layout.addWidget(self.table)
+        layout.addWidget(self._canvas)
+
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.timeout.connect(self.on_refresh)
+        self._refresh_timer.start(1000)
+
+    @pyqtSlot()
+    def on_refresh(self):
+        if not self.isVisible():
+            return
+        category = self.category_cbb.currentText()
+        r = self._residuals.latest(category)
+        if r is None:
+            self.table.setRowCount(0)
+            self.rms_lbl.setText("")
+        else:
+            self.rms_lbl.setText(f"RMS (mm) X: {r.rms1:.3f}, Y: {r.rms2:.3f}")
+            self.table.setRowCount(len(r.s))
+            self.table.setVerticalHeaderLabels(
+                    [n or str(i + 1) for i, n in enumerate(r.names)])
+            for i, row in enumerate(zip(r.s, r.r1, r.r2)):
+                for j, v in enumerate(row):
+                    self.table.setItem(i, j, QTableWidgetItem(f"{v:.3f}"))
+            self.table.resizeColumnsToContents()
+        t, rms1, rms2 = self._residuals.history(category)
+        if t.size:
+            t = t - t[-1]
+        for line, y in zip(self._lines, (rms1, rms2)):
+            line.set_data(t, y)
+        self._ax.relim()
+        self._ax.autoscale_view()
+        self._canvas.draw_idle()
+
+    def showEvent(self, e):
+        QWidget.showEvent(self, e)
+        self.on_refresh()
+
+
+class ReplayWidget(QWidget):
+    """Controls to play back a recording of the model, the ticks are emitted
+    by :attr:`tickReady`.
+    """
+    # index, tick (dict), see RecordingReader.tick()
+    tickReady = pyqtSignal(int, object)
+    # widget is closed
+    replayStopped = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self.setWindowTitle("Replay")
+        self.player = None
+        self._reader = None
+
+        self.open_btn = QPushButton("Open")
+        self.open_btn.clicked.connect(self.on_open)
+        self.file_lbl = QLabel("No recording is opened.")
+        self.prev_btn = QPushButton("<")
+        self.prev_btn.clicked.connect(lambda: self.player.step(-1))
+        self.play_btn = QPushButton("Play")
+        self.play_btn.setCheckable(True)
+        self.play_btn.toggled.connect(self.on_play)
+        self.next_btn = QPushButton(">")
+        self.next_btn.clicked.connect(lambda: self.player.step(1))
+        self.speed_dsbox = QDoubleSpinBox()
+        self.speed_dsbox.setRange(0, 1000)
+        self.speed_dsbox.setValue(1.0)
+        self.speed_dsbox.setSuffix(" x")
+        self.speed_dsbox.setSpecialValueText("Max")
+        self.speed_dsbox.setToolTip("Playback speed relative to real time.")
+        self.speed_dsbox.valueChanged.connect(self.on_speed_changed)
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.sliderMoved.connect(lambda i: self.player.seek(i))
+        self.pos_lbl = QLabel()
+        self.rerun_chkbox = QCheckBox("Run model with recorded settings")
+        self.rerun_chkbox.setToolTip(
+                "Run the model of the loaded lattice instead of showing the recorded results.")
+
+        hbox1 = QHBoxLayout()
+        hbox1.addWidget(self.open_btn)
+        hbox1.addWidget(self.file_lbl, 1)
+        hbox2 = QHBoxLayout()
+        for o in (self.prev_btn, self.play_btn, self.next_btn):
+            hbox2.addWidget(o)
+        hbox2.addWidget(QLabel("Speed"))
+        hbox2.addWidget(self.speed_dsbox)
+        hbox2.addWidget(self.slider, 1)
+        hbox2.addWidget(self.pos_lbl)
+        layout = QVBoxLayout(self)
+        layout.addLayout(hbox1)
+        layout.addLayout(hbox2)
+        layout.addWidget(self.rerun_chkbox)
+        self._set_controls_enabled(False)
+
+    @property
+    def rerun_model(self):
+        return self.rerun_chkbox.isChecked()
+
+    def _set_controls_enabled(self, enabled):
+        for o in (self.prev_btn, self.play_btn, self.next_btn, self.slider):
+            o.setEnabled(enabled)
+
+    @pyqtSlot()
+    def on_open(self):
+        filepath, _ = QFileDialog.getOpenFileName(self, "Open a recording", '.',
+                "Recordings (*.h5 *.hdf5 meta.json)")
+        if not filepath:
+            return
+        if pathlib.Path(filepath).name == "meta.json":
+            # NPZ recording is a directory.
+            filepath = str(pathlib.Path(filepath).parent)
+        self.open(filepath)
+
+    def open(self, filepath):
+        """Open the recording *filepath* and show the first tick.
+        """
+        if self.player is not None:
+            self.player.pause()
+        if self._reader is not None:
+            self._reader.close()
+        try:
+            self._reader = RecordingReader(filepath)
+        except Exception as e:
+            QMessageBox.warning(self, "Replay", f"Cannot open {filepath}: {e}",
+                                QMessageBox.Ok)
+            return
+        self.player = ReplayPlayer(self._reader, self)
+        self.player.speed = self.speed_dsbox.value()
+        self.player.tickReady.connect(self.on_tick)
+        self.player.stateChanged.connect(self.play_btn.setChecked)
+        self.file_lbl.setText(f"{filepath} ({len(self.player)} updates)")
+        self.slider.setRange(0, max(len(self.player) - 1, 0))
+        self._set_controls_enabled(len(self.player) > 0)
+        self.player.seek(0)
+
+    @pyqtSlot(bool)
+    def on_play(self, toggled):
+        if self.player is None:
+            return
+        if toggled:
+            self.player.play()
+        else:
+            self.player.pause()
+
+    @pyqtSlot(float)
+    def on_speed_changed(self, x):
+        if self.player is not None:
+            self.player.speed = x
+
+    @pyqtSlot(int, object)
+    def on_tick(self, i, tick):
+        self.slider.blockSignals(True)
+        self.slider.setValue(i)
+        self.slider.blockSignals(False)
+        ts = datetime.datetime.fromtimestamp(tick['time']).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        self.pos_lbl.setText(f"{i + 1}/{len(self.player)} {ts}")
+        self.tickReady.emit(i, tick)
+
+    def closeEvent(self, e):
+        if self.player is not None:
+            self.player.pause()
+        self.replayStopped.emit()
+        QWidget.closeEvent(self, e)
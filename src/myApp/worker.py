@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Long-lived simulation worker of the online model, and the coalescer of
+the setting changes from the UI.
+"""
+import queue
+import time
+
+from PyQt5.QtCore import QObject
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import pyqtSignal
+
+# default settle window for setting changes, millisecond
+DEFAULT_SETTLE_WINDOW = 200
+
+# request to stop the worker
+_STOP = object()
+
+
+class SimulationWorker(QThread):
+    """Run *func* in one persistent thread, either on request or periodically
+    in the auto-update mode.
+
+    *func* is called with the request passed to ``submit`` (None for the
+    periodic ones), it should read the other simulation parameters when
+    called, its return value is emitted with ``resultsReady`` if it is not
+    None.
+
+    Requests are kept in a bounded queue, a new request replaces the pending
+    one, so the simulation is always done with the latest parameters.
+    """
+    # simulation started, auto-update mode or not
+    simStarted = pyqtSignal(bool)
+    # simulation finished, auto-update mode or not
+    simFinished = pyqtSignal(bool)
+    # simulated results
+    resultsReady = pyqtSignal(object)
+
+    def __init__(self, func, interval=1.0, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self._func = func
+        self._queue = queue.Queue(maxsize=1)
+        self.interval = interval # second, auto-update period
+        self.auto = False
+
+    def submit(self, request=None):
+        """Request a simulation with *request* for *func*, drop the pending
+        one if any.
+        """
+        while True:
+            try:
+                self._queue.put_nowait(request)
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+            else:
+                break
+
+    def set_auto(self, enabled):
+        """Turn on/off the auto-update mode, start the first cycle right away.
+        """
+        self.auto = enabled
+        if enabled:
+            self.submit()
+
+    def stop(self):
+        """Stop the worker thread after the current simulation.
+        """
+        self.auto = False
+        self.submit(_STOP)
+        self.wait()
+
+    def run(self):
+        t_next = None
+        while True:
+            timeout = None
+            if self.auto and t_next is not None:
+                timeout = max(t_next - time.time(), 0)
+            try:
+                req = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                if not self.auto:
+                    continue
+                req = None
+            if req is _STOP:
+                break
+            auto = self.auto
+            t0 = time.time()
+            self.simStarted.emit(auto)
+            try:
+                r = self._func(req)
+            except Exception as e:
+                print(f"Simulation failed: {e}")
+            else:
+                if r is not None:
+                    self.resultsReady.emit(r)
+            finally:
+                self.simFinished.emit(auto)
+            if auto:
+                dt = time.time() - t0
+                if dt > self.interval:
+                    print(f"Update rate is: {1.0 / dt:.1f} Hz")
+                t_next = t0 + self.interval
+            else:
+                t_next = None
+
+
+class SettingCoalescer(QObject):
+    """Coalesce rapid setting changes, only the latest value of each field is
+    written when no new change comes within the settle window (millisecond),
+    then ``settingsApplied`` is emitted to request one simulation.
+    """
+    # all the pending settings are written
+    settingsApplied = pyqtSignal()
+
+    def __init__(self, settle=DEFAULT_SETTLE_WINDOW, parent=None):
+        super(self.__class__, self).__init__(parent)
+        self._pending = {}
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.flush)
+        self.settle = settle
+
+    @property
+    def settle(self):
+        return self._timer.interval()
+
+    @settle.setter
+    def settle(self, ms):
+        self._timer.setInterval(int(ms))
+
+    def push(self, fld, value):
+        """Set *fld* (CaField) with *value* after the settle window, the
+        previous pending value of *fld* is discarded.
+        """
+        self._pending[fld] = value
+        self._timer.start()
+
+    def flush(self):
+        """Write all the pending settings now.
+        """
+        self._timer.stop()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        for fld, value in pending.items():
+            fld.value = value
+        self.settingsApplied.emit()